@@ -0,0 +1,420 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from lxml import html
+import clear_engine
+import clear_io
+from clear_common import ReferenceIndex, remove_empty_elements
+from clear_fuzzy import FUZZY_THRESHOLD, FuzzyIndex
+from clear_lite import FLUSH_CHARS, clean_streaming
+from clear_manifest import file_hash
+from clear_metrics import Metrics, count_nodes
+from clear_rules import BoilerplateRules, rules_for_file
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不报告内存峰值
+    resource = None
+
+MODES = ('memory', 'stream', 'scheduler')
+# 'all' 是一次运行同时输出所有变体
+VARIANT_SETS = {name: [name] for name in clear_engine.VARIANTS}
+VARIANT_SETS['all'] = list(clear_engine.VARIANTS)
+
+# 默认超过10%的变化算作性能回退
+REGRESSION_THRESHOLD = 0.1
+
+
+def site_files(folder):
+    return sorted(os.path.join(folder, filename) for filename in os.listdir(folder) if filename.endswith('_hp.json'))
+
+
+def scale_site(src_file, dst_file, scale):
+    """Write a copy of a site with every page repeated scale times under new urls, keeping the hierarchy."""
+    with open(src_file, 'r', encoding='utf-8') as f:
+        companies = json.load(f).get('data', [])
+    pages = []
+    for copy_no in range(scale):
+        for company in companies:
+            page = dict(company)
+            if copy_no:
+                # 每一份副本是一棵独立的页面树，p_url 为空的页面仍然是主页面
+                page['url'] = f"{company.get('url')}?bench={copy_no}"
+                if company.get('p_url'):
+                    page['p_url'] = f"{company.get('p_url')}?bench={copy_no}"
+            pages.append(page)
+    clear_io.write_pages(dst_file, pages)
+
+
+def build_corpora(src_folder, work_folder, synthetic_sites=3, synthetic_scale=8):
+    """Return {corpus name: folder}: the source folder, plus its largest sites scaled up when synthetic_sites > 0."""
+    corpora = {'source': src_folder}
+    if synthetic_sites and synthetic_scale > 1:
+        folder = os.path.join(work_folder, f'synthetic_x{synthetic_scale}')
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        for src_file in sorted(site_files(src_folder), key=os.path.getsize, reverse=True)[:synthetic_sites]:
+            scale_site(src_file, os.path.join(folder, os.path.basename(src_file)), synthetic_scale)
+        corpora[f'synthetic_x{synthetic_scale}'] = folder
+    return corpora
+
+
+def corpus_size(folder):
+    """Return (files, pages, bytes) of the site files in folder."""
+    files = site_files(folder)
+    pages = 0
+    for src_file in files:
+        pages += sum(1 for _ in clear_io.iter_pages(src_file))
+    return len(files), pages, sum(os.path.getsize(src_file) for src_file in files)
+
+
+def output_digest(folder):
+    """Hash every output file of a folder, leaving out the manifest."""
+    return {filename: file_hash(os.path.join(folder, filename))
+            for filename in sorted(os.listdir(folder)) if filename.endswith('_hp.json')}
+
+
+def matching_pages(folder, expected_folder):
+    """Count the pages of folder whose cleaned body_html_new and body_new equal those in expected_folder."""
+    matched = 0
+    for filename in sorted(os.listdir(folder)):
+        expected_file = os.path.join(expected_folder, filename)
+        if not filename.endswith('_hp.json') or not os.path.exists(expected_file):
+            continue
+        for page, expected in zip(clear_io.iter_pages(os.path.join(folder, filename)), clear_io.iter_pages(expected_file)):
+            if page.get('body_html_new') == expected.get('body_html_new') and page.get('body_new') == expected.get('body_new'):
+                matched += 1
+    return matched
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    # Linux 上 ru_maxrss 的单位是 KiB
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_case(case, results):
+    """Run one benchmark case in a fresh process and put its measurements on the results queue."""
+    logging.basicConfig(level=case['log_level'], format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics = Metrics()
+    outputs = {}
+    for name in case['variants']:
+        outputs[name] = os.path.join(case['out_folder'], name)
+        if os.path.exists(outputs[name]):
+            shutil.rmtree(outputs[name])
+        os.makedirs(outputs[name])
+
+    start_time = time.perf_counter()
+    if case['mode'] == 'scheduler':
+        metrics = clear_engine.process_json_files_in_folder(case['src_folder'], outputs, case['processes'], incremental=False)
+    else:
+        for src_file in site_files(case['src_folder']):
+            clear_engine.process_file(src_file, outputs, stream=case['mode'] == 'stream', metrics=metrics)
+    seconds = time.perf_counter() - start_time
+
+    results.put({
+        'seconds': seconds,
+        'stages': metrics.stage_seconds(),
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        'workers_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        'outputs': {name: output_digest(folder) for name, folder in outputs.items()},
+        'expected_pages': {name: matching_pages(folder, case['expected_folder'])
+                           for name, folder in outputs.items()} if case['expected_folder'] else {},
+    })
+
+
+def measure(case, repeat):
+    """Run a case repeat times, each in a new process, and keep the fastest run."""
+    context = multiprocessing.get_context('spawn')
+    best = None
+    peak = None
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=run_case, args=(case, results))
+        process.start()
+        result = results.get()
+        process.join()
+        if process.exitcode:
+            raise RuntimeError(f"Benchmark case {case['name']} failed with exit code {process.exitcode}")
+        if result['peak_rss_mb'] is not None:
+            peak = max(peak or 0, result['peak_rss_mb'])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    # 耗时取最快的一次，内存峰值取所有重复中的最大值
+    return dict(best, peak_rss_mb=peak)
+
+
+def run_benchmarks(src_folder='source_folder', expected_folder='test_output', work_folder=None, variants=VARIANT_SETS,
+                   modes=MODES, repeat=3, processes=None, synthetic_sites=3, synthetic_scale=8, log_level=logging.WARNING):
+    """Benchmark every variant set in every mode on every corpus and return the results.
+
+    Each result holds the throughput (pages/s, MB/s), the time of each stage
+    (summed over the workers in scheduler mode), the peak RSS, the hash of every output
+    file and how many pages match expected_folder. Outputs of the same variant
+    must be identical in all modes and variant sets; mismatches are returned
+    under 'mismatches'.
+    """
+    if work_folder is None:
+        work_folder = os.path.join(tempfile.gettempdir(), 'clear_bench')
+    corpora = build_corpora(src_folder, work_folder, synthetic_sites, synthetic_scale)
+    cases = []
+    for corpus, folder in corpora.items():
+        files, pages, size = corpus_size(folder)
+        for variant_set, names in variants.items():
+            for mode in modes:
+                name = f'{corpus}/{variant_set}/{mode}'
+                case = {
+                    'name': name, 'src_folder': folder, 'variants': names, 'mode': mode, 'processes': processes,
+                    'out_folder': os.path.join(work_folder, 'out', corpus, variant_set, mode), 'log_level': log_level,
+                    # 只有原始语料有可对比的输出
+                    'expected_folder': expected_folder if corpus == 'source' and expected_folder and os.path.exists(expected_folder) else None,
+                }
+                result = measure(case, repeat)
+                result.update({'case': name, 'corpus': corpus, 'variant_set': variant_set, 'mode': mode,
+                               'files': files, 'pages': pages, 'megabytes': size / 1024 / 1024})
+                result['pages_per_second'] = pages / result['seconds'] if result['seconds'] else 0
+                result['megabytes_per_second'] = result['megabytes'] / result['seconds'] if result['seconds'] else 0
+                log_result(result)
+                cases.append(result)
+    return {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'cases': cases, 'mismatches': output_mismatches(cases)}
+
+
+def removed_ranges(index, content):
+    """Parse content, remove what index matches and return the text ranges removed and the seconds it took.
+
+    The ranges are sorted and merged: an element that contains the page root
+    is removed together with elements inside it.
+    """
+    soup = html.fromstring(content)
+    ranges = []
+    start_time = time.perf_counter()
+    index.remove_matches(soup, lambda element, span: ranges.append((span[0], span[1])))
+    seconds = time.perf_counter() - start_time
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged, seconds
+
+
+def covered(ranges, others):
+    """Count the characters of ranges that also lie in one of the sorted ranges of others."""
+    total = 0
+    for start, end in ranges:
+        for other_start, other_end in others:
+            if other_start >= end:
+                break
+            total += max(0, min(end, other_end) - max(start, other_start))
+    return total
+
+
+def compare_fuzzy(src_folder='source_folder', threshold=FUZZY_THRESHOLD, variant=clear_engine.SIMPLIFIED):
+    """Compare the near-duplicate mode of the similar stage with the exact mode, page by page.
+
+    Every page that has a reference page in variant is cleaned against it with
+    a ReferenceIndex and with a FuzzyIndex. Recall is the share of the
+    characters removed by the exact mode that the fuzzy mode removes too;
+    extra is what only the fuzzy mode removes. Latencies are per page, index
+    building left out.
+    """
+    exact_chars = recalled_chars = extra_chars = 0
+    latencies = {'exact': [], 'fuzzy': []}
+    for src_file in site_files(src_folder):
+        companies = clear_engine.load_pages(src_file)
+        if companies is None:
+            continue
+        _, keys = clear_engine.plan_variant(variant, companies)
+        indexes = {}
+        for position, key in keys.items():
+            content = companies[position].get('body_html')
+            if key is None or not content or not companies[key].get('body_html'):
+                continue
+            if key not in indexes:
+                soup = html.fromstring(companies[key].get('body_html'))
+                indexes[key] = ReferenceIndex(soup), FuzzyIndex(soup, threshold)
+            exact_index, fuzzy_index = indexes[key]
+            exact, exact_seconds = removed_ranges(exact_index, content)
+            fuzzy, fuzzy_seconds = removed_ranges(fuzzy_index, content)
+            latencies['exact'].append(exact_seconds)
+            latencies['fuzzy'].append(fuzzy_seconds)
+            exact_total = sum(end - start for start, end in exact)
+            recalled = covered(exact, fuzzy)
+            exact_chars += exact_total
+            recalled_chars += recalled
+            extra_chars += sum(end - start for start, end in fuzzy) - covered(fuzzy, exact)
+    report = {'threshold': threshold, 'pages': len(latencies['exact']), 'exact_chars': exact_chars,
+              'recall': recalled_chars / exact_chars if exact_chars else 1.0, 'extra_chars': extra_chars}
+    for mode, seconds in latencies.items():
+        report[f'{mode}_ms_mean'] = statistics.mean(seconds) * 1000 if seconds else 0.0
+        report[f'{mode}_ms_p50'] = statistics.median(seconds) * 1000 if seconds else 0.0
+        report[f'{mode}_ms_max'] = max(seconds) * 1000 if seconds else 0.0
+    logging.info(f"Fuzzy similar stage at {threshold}: {report['pages']} pages, recall {report['recall']:.1%} of "
+                 f"{exact_chars} characters removed by the exact mode, {extra_chars} more characters removed; "
+                 f"{report['exact_ms_p50']:.2f} ms -> {report['fuzzy_ms_p50']:.2f} ms per page (p50), "
+                 f"{report['exact_ms_mean']:.2f} ms -> {report['fuzzy_ms_mean']:.2f} ms (mean)")
+    return report
+
+
+def clean_tree(content, rules, block_text=False):
+    """Clean a page without reference page the way the tree engine does; same result as clear_lite.clean_streaming."""
+    soup = html.fromstring(content)
+    has_children = len(soup) > 0
+    nodes = count_nodes(soup)
+    clear_engine.remove_common_footers(soup, rules)
+    remove_empty_elements(soup)
+    body_html, body_text = clear_engine.serialize(soup, block_text)
+    return body_html, body_text, has_children, nodes, count_nodes(soup)
+
+
+def compare_streaming(src_folder='source_folder', flush_chars=FLUSH_CHARS):
+    """Check clear_lite.clean_streaming against the tree engine on every page, with the footer rules and text format of every variant.
+
+    Every page is cleaned as if it had no reference page, by both engines; the
+    results must be identical, except for the pages the streaming engine
+    hands back to the tree engine (fallback). A small flush_chars makes the
+    streaming engine serialize often, which checks that path too. Latencies
+    are per page, reading the file left out.
+    """
+    same = different = fallback = 0
+    latencies = {'tree': [], 'stream': []}
+    for src_file in site_files(src_folder):
+        companies = clear_engine.load_pages(src_file)
+        if companies is None:
+            continue
+        rule_sets = {(tuple(map(str, variant.footer_rules)), variant.block_text): (variant.footer_rules, variant.block_text)
+                     for variant in clear_engine.VARIANTS.values()}
+        for footer_rules, block_text in rule_sets.values():
+            rules = rules_for_file(BoilerplateRules(footer_rules), src_file)
+            for company in companies:
+                content = company.get('body_html')
+                if not content:
+                    continue
+                start_time = time.perf_counter()
+                expected = clean_tree(content, rules, block_text)
+                latencies['tree'].append(time.perf_counter() - start_time)
+                start_time = time.perf_counter()
+                streamed = clean_streaming(content, rules, flush_chars, block_text)
+                latencies['stream'].append(time.perf_counter() - start_time)
+                if streamed is None:
+                    fallback += 1
+                elif streamed == expected:
+                    same += 1
+                else:
+                    different += 1
+                    logging.warning(f"Streaming engine differs from the tree engine on {company.get('url')} in {src_file}")
+    report = {'flush_chars': flush_chars, 'pages': same + different + fallback, 'same': same, 'different': different, 'fallback': fallback}
+    for engine, seconds in latencies.items():
+        report[f'{engine}_ms_mean'] = statistics.mean(seconds) * 1000 if seconds else 0.0
+        report[f'{engine}_ms_p50'] = statistics.median(seconds) * 1000 if seconds else 0.0
+        report[f'{engine}_ms_max'] = max(seconds) * 1000 if seconds else 0.0
+    logging.info(f"Streaming engine: {same} of {report['pages']} pages identical to the tree engine, {different} different, "
+                 f"{fallback} left to the tree engine; {report['tree_ms_p50']:.2f} ms -> {report['stream_ms_p50']:.2f} ms "
+                 f"per page (p50), {report['tree_ms_max']:.2f} ms -> {report['stream_ms_max']:.2f} ms (max)")
+    return report
+
+
+def output_mismatches(cases):
+    """Return a message for every case whose output of a variant differs from the first case of that variant and corpus."""
+    first = {}
+    mismatches = []
+    for result in cases:
+        for name, digest in result['outputs'].items():
+            key = (result['corpus'], name)
+            if key not in first:
+                first[key] = (result['case'], digest)
+            elif digest != first[key][1]:
+                files = sorted(filename for filename in set(digest) | set(first[key][1])
+                               if digest.get(filename) != first[key][1].get(filename))
+                mismatches.append(f"{result['case']}: {name} output differs from {first[key][0]} in {len(files)} files, e.g. {files[0]}")
+    return mismatches
+
+
+def log_result(result):
+    rss = f", peak RSS {result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] else ''
+    logging.info(f"{result['case']}: {result['pages']} pages in {result['seconds']:.2f} seconds, "
+                 f"{result['pages_per_second']:.1f} pages/s, {result['megabytes_per_second']:.2f} MB/s{rss}")
+    if result['stages']:
+        stages = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in sorted(result['stages'].items(), key=lambda item: -item[1]))
+        logging.info(f"  stages: {stages}")
+    for name, matched in result['expected_pages'].items():
+        logging.info(f"  {name}: {matched} pages match the expected output")
+
+
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compare results with a stored baseline and return a message for every regression beyond threshold.
+
+    Throughput falling, peak RSS rising, fewer pages matching the expected
+    output and any output mismatch between modes all count as regressions.
+    """
+    regressions = list(results['mismatches'])
+    previous = {result['case']: result for result in baseline['cases']}
+    for result in results['cases']:
+        before = previous.get(result['case'])
+        if before is None:
+            continue
+        if result['pages_per_second'] < before['pages_per_second'] * (1 - threshold):
+            regressions.append(f"{result['case']}: {result['pages_per_second']:.1f} pages/s, "
+                               f"was {before['pages_per_second']:.1f} ({result['pages_per_second'] / before['pages_per_second'] - 1:+.0%})")
+        if result['peak_rss_mb'] and before['peak_rss_mb'] and result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + threshold):
+            regressions.append(f"{result['case']}: peak RSS {result['peak_rss_mb']:.0f} MB, was {before['peak_rss_mb']:.0f} MB")
+        for name, matched in result['expected_pages'].items():
+            if matched < before['expected_pages'].get(name, 0):
+                regressions.append(f"{result['case']}: {name} matches the expected output in {matched} pages, "
+                                   f"was {before['expected_pages'][name]}")
+    return regressions
+
+
+def save_results(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+def load_results(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    src_folder = 'source_folder'  # 基准测试用的语料
+    expected_folder = 'test_output'  # 对比输出用的文件夹，设置为None时不对比
+    results_path = 'bench_results.json'  # 本次结果保存的位置
+    baseline_path = 'bench_baseline.json'  # 基准结果，存在时和本次结果对比
+    save_baseline = False  # 可选：设置为True时把本次结果保存为新的基准
+    repeat = 3  # 每个用例运行的次数，取最快的一次
+    synthetic_sites = 3  # 放大的站点数量，设置为0时只测原始语料
+    synthetic_scale = 8  # 每个放大站点的页面重复次数
+    threshold = REGRESSION_THRESHOLD  # 超过这个比例的变化算作回退
+    fuzzy_threshold = None  # 可选：设置为0到1之间的数（如0.8）时，另外比较近似重复模式和精确模式的召回率和耗时
+    compare_stream = False  # 可选：设置为True时，另外逐页检查流式引擎的输出和树引擎是否相同
+
+    results = run_benchmarks(src_folder, expected_folder, repeat=repeat, synthetic_sites=synthetic_sites,
+                             synthetic_scale=synthetic_scale)
+    save_results(results, results_path)
+    logging.info(f"Saved benchmark results to {results_path}")
+    if os.path.exists(baseline_path):
+        regressions = compare_results(results, load_results(baseline_path), threshold)
+    else:
+        regressions = results['mismatches']
+    for regression in regressions:
+        logging.warning(f"Regression: {regression}")
+    if not regressions:
+        logging.info("No regressions")
+    if save_baseline:
+        save_results(results, baseline_path)
+        logging.info(f"Saved benchmark baseline to {baseline_path}")
+    if fuzzy_threshold:
+        compare_fuzzy(src_folder, fuzzy_threshold)
+    if compare_stream:
+        report = compare_streaming(src_folder)
+        if report['different']:
+            logging.warning(f"Regression: the streaming engine differs from the tree engine on {report['different']} pages")
@@ -0,0 +1,350 @@
+import copy
+import hashlib
+import logging
+import sys
+import time
+from collections import OrderedDict
+from lxml import etree, html
+from lxml.html import HtmlComment, defs
+
+# 比较结尾时最多比较的文本块数，耗时和页面长度无关
+ENDING_BLOCKS = 64
+# lxml 解析树占用的内存约为 HTML 字符数的10倍（实测）
+TREE_BYTES_PER_CHAR = 10
+# 参考页面解析树的内存预算，超出时丢弃最久未用的树，需要时重新解析
+REFERENCE_BUDGET = 256 << 20
+# 文本中单独成行的元素：lxml 的块元素、HTML5 的分区元素和 br
+BLOCK_TAGS = defs.block_tags | {'article', 'aside', 'body', 'br', 'details', 'figcaption', 'figure', 'footer', 'header', 'html', 'main', 'nav',
+                                'section', 'summary'}
+# 块元素边界在原始文本中的标记（私用区字符），整理文本时换成换行
+BLOCK_BREAK = '\ue002'
+# 在 libxslt 里走一遍树：文本节点原样输出，注释不输出，块元素前后加上标记
+_BLOCK_TEXT = etree.XSLT(etree.XML(f'''<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:output method="text" encoding="UTF-8"/>
+<xsl:template match="{'|'.join(sorted(BLOCK_TAGS))}">&#x{ord(BLOCK_BREAK):X};<xsl:apply-templates/>&#x{ord(BLOCK_BREAK):X};</xsl:template>
+</xsl:stylesheet>'''))
+
+
+def text_fingerprint(text):
+    """Return a 64-bit fingerprint of text that is stable across processes."""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def raw_block_text(element):
+    """Return the text of element, without its tail, with BLOCK_BREAK around the text of every block element.
+
+    Removing the breaks gives element.text_content(); see normalize_text.
+    """
+    return str(_BLOCK_TEXT(element))
+
+
+def normalize_text(raw):
+    """Turn raw_block_text output into one line per block, with every run of whitespace collapsed to a space and no empty lines."""
+    return '\n'.join(filter(None, (' '.join(line.split()) for line in raw.split(BLOCK_BREAK))))
+
+
+def remove_empty_elements(soup):
+    """Remove comments and elements that have no content, attributes, or child elements.
+
+    A single post-order pass: children are visited before their parent, so by
+    the time an element is checked its empty descendants are already gone and
+    its text_content() is just its own text. Each check is therefore O(1).
+    """
+    if soup is None:
+        return
+    for element in reversed(list(soup.iter())):
+        if isinstance(element, HtmlComment) or not (len(element) or element.attrib or (element.text and element.text.strip())):
+            parent = element.getparent()
+            if parent is not None:
+                parent.remove(element)
+
+
+def text_spans(soup):
+    """Walk the document containing soup once and return its text plus the text span of every element.
+
+    Elements are returned in document order, the same order as ``xpath('//*')``.
+    Each span is ``[start, end, last]``: ``text[start:end]`` equals the element's
+    ``text_content()`` and ``elements[last]`` is its last descendant. When soup
+    or one of its ancestors was removed, only that detached subtree is walked.
+    """
+    # 被删除的子树仍属于原文档，getroot() 会返回原文档的根，所以从 soup 最上层的祖先开始
+    root = soup
+    for root in soup.iterancestors():
+        pass
+    chunks = []
+    position = 0
+    elements = []
+    spans = []
+    open_elements = []
+    for event, node in etree.iterwalk(root, events=('start', 'end', 'comment', 'pi')):
+        if event == 'start':
+            open_elements.append(len(elements))
+            elements.append(node)
+            spans.append([position, position, 0])
+            if node.text:
+                chunks.append(node.text)
+                position += len(node.text)
+            continue
+        if event == 'end':
+            span = spans[open_elements.pop()]
+            span[1] = position
+            span[2] = len(elements) - 1
+        # 注释本身的文字不算在 text_content() 里，但其后的 tail 要算
+        if node.tail and node is not root:
+            chunks.append(node.tail)
+            position += len(node.tail)
+    return ''.join(chunks), elements, spans
+
+
+def ending_blocks(text, elements, spans, soup, limit=ENDING_BLOCKS):
+    """Return the last limit text blocks of soup, last first, as (start, end, fingerprint), given text_spans(soup).
+
+    A block is the non-blank text between two element boundaries, in practice
+    one text node; text[start:end] is the block without surrounding
+    whitespace and the fingerprint is taken over its whitespace-normalized
+    text. Only the returned blocks are hashed.
+    """
+    soup_position = next(position for position, element in enumerate(elements) if element is soup)
+    boundaries = set()
+    for start, end, _ in spans[soup_position:spans[soup_position][2] + 1]:
+        boundaries.add(start)
+        boundaries.add(end)
+    boundaries = sorted(boundaries, reverse=True)
+    blocks = []
+    for end, start in zip(boundaries, boundaries[1:]):
+        block = text[start:end]
+        if block.strip():
+            blocks.append((start + len(block) - len(block.lstrip()), start + len(block.rstrip()), text_fingerprint(' '.join(block.split()))))
+            if len(blocks) == limit:
+                break
+    return blocks
+
+
+class ReferenceIndex:
+    """Fingerprints of the stripped text of every element of a reference page.
+
+    Built in one walk over the page, so matching a child page against it no
+    longer calls ``text_content()`` on every element of both trees. Together
+    with the fingerprints of the page's last text blocks (``ending``, last
+    first) it is all the cleaning stages need from a reference, so the parsed
+    tree can be dropped once the index is built.
+    """
+
+    def __init__(self, soup):
+        start_time = time.perf_counter()
+        # clear_hp 只和根元素有子元素的父页面对比
+        self.has_children = len(soup) > 0
+        text, elements, spans = text_spans(soup)
+        self.fingerprints = {}
+        for position, (start, end, _) in enumerate(spans):
+            element_text = text[start:end].strip()
+            if element_text:
+                self.fingerprints[text_fingerprint(element_text)] = position
+        self.ending = [fingerprint for _, _, fingerprint in ending_blocks(text, elements, spans, soup)]
+        self.build_time = time.perf_counter() - start_time
+        self.nbytes = (sys.getsizeof(self.fingerprints) + sys.getsizeof(self.ending)
+                       + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in self.fingerprints.items()))
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, text):
+        return text_fingerprint(text) in self.fingerprints
+
+    def remove_matches(self, soup, on_remove=None):
+        """Remove elements of soup whose stripped text appears in the reference page.
+
+        Elements are visited in document order and the subtree of a removed
+        element is skipped, unless it contains soup itself: soup is what gets
+        serialized, so it is still cleaned after being detached from the
+        implied <html> root. Returns the removed elements; on_remove is called
+        as in remove_blocks.
+        """
+        text, elements, spans = text_spans(soup)
+
+        def is_match(position):
+            start, end, _ = spans[position]
+            element_text = text[start:end].strip()
+            return bool(element_text) and text_fingerprint(element_text) in self.fingerprints
+
+        return remove_blocks(soup, elements, spans, is_match, on_remove)
+
+
+def remove_blocks(soup, elements, spans, is_match, on_remove=None):
+    """Remove the elements for which is_match(position) is true, as returned by text_spans(soup).
+
+    Elements are visited in document order and the subtree of a removed
+    element is skipped, unless it contains soup itself. on_remove(element,
+    span) is called just before each element is removed. Returns the removed
+    elements.
+    """
+    soup_position = next(position for position, element in enumerate(elements) if element is soup)
+    removed = []
+    position = 0
+    while position < len(elements):
+        last = spans[position][2]
+        if is_match(position):
+            element = elements[position]
+            parent = element.getparent()
+            if parent is not None:
+                if on_remove is not None:
+                    on_remove(element, spans[position])
+                parent.remove(element)
+                removed.append(element)
+                if not position <= soup_position <= last:
+                    position = last + 1
+                    continue
+        position += 1
+    return removed
+
+
+def remove_ending(soup, ending, window=None, whole=False, on_remove=None):
+    """Remove the longest trailing run of text blocks of soup that is also the ending of a reference page.
+
+    ending holds the fingerprints of the reference's last blocks, last first
+    (ReferenceIndex.ending). The blocks are compared from the end, so the cost
+    is bounded by len(ending) whatever the length of the texts. With window,
+    only blocks starting in the last window characters of soup's text count.
+    Unless whole, the first block of soup is always kept. The elements of soup
+    whose text is all inside the run are removed, outermost first, and
+    returned; on_remove is called as in remove_blocks.
+    """
+    if not ending:
+        return []
+    text, elements, spans = text_spans(soup)
+    blocks = ending_blocks(text, elements, spans, soup, len(ending) + 1)
+    soup_position = next(position for position, element in enumerate(elements) if element is soup)
+    soup_start, soup_end, soup_last = spans[soup_position]
+    shared = 0
+    for (start, _, fingerprint), reference_fingerprint in zip(blocks, ending):
+        if fingerprint != reference_fingerprint or (window is not None and start < soup_end - window):
+            break
+        shared += 1
+    # 所有文本块都和参考页面的结尾相同时，不加 whole 就保留第一块
+    if shared and shared == len(blocks) and not whole:
+        shared -= 1
+    if not shared:
+        return []
+
+    cut = blocks[shared - 1][0]
+    # 最后一个保留的文本块结束的位置，之后开始、且含有结尾文本的元素都要删除
+    kept_end = blocks[shared][1] if shared < len(blocks) else soup_start
+    removed = []
+    position = soup_position + 1
+    while position <= soup_last:
+        start, end, last = spans[position]
+        if start >= cut or (start >= kept_end and end > cut):
+            element = elements[position]
+            if on_remove is not None:
+                on_remove(element, spans[position])
+            element.getparent().remove(element)
+            removed.append(element)
+            position = last + 1
+            continue
+        position += 1
+    return removed
+
+
+def build_reference_index(soup, label=None, index_factory=ReferenceIndex):
+    """Build the ReferenceIndex (or what index_factory builds) of a reference page and log its build time and size."""
+    if soup is None:
+        return None
+    reference_index = index_factory(soup)
+    logging.info(f"Built reference index for {label}: {len(reference_index)} fingerprints, "
+                 f"{reference_index.nbytes / 1024:.1f} KiB in {reference_index.build_time * 1000:.1f} ms")
+    return reference_index
+
+
+class DocumentCache:
+    """Parse each page's HTML at most once per file.
+
+    Pages registered as references keep a pristine tree that is never modified;
+    working trees handed out for cleaning are deep copies of it, which is much
+    cheaper than parsing the HTML again. Pages that are never used as a
+    reference are parsed straight into a working tree. Reference indexes are
+    built by index_factory, e.g. clear_fuzzy.index_factory(threshold).
+
+    The pristine trees are kept in least-recently-used order within budget
+    bytes (estimated from the HTML length, None for no limit); an evicted
+    tree is parsed again when it is needed. release() drops the tree and
+    index of a reference no remaining page is compared with. peak_nbytes is
+    the most memory the trees and indexes took at any one time.
+    """
+
+    def __init__(self, references=(), index_factory=ReferenceIndex, budget=REFERENCE_BUDGET):
+        self._references = {content for content in references if content}
+        self.index_factory = index_factory
+        self.budget = budget
+        self._trees = OrderedDict()
+        self._indexes = {}
+        self.tree_nbytes = 0
+        self.index_nbytes = 0
+        self.peak_nbytes = 0
+        self.parses = 0
+        self.copies = 0
+        self.evictions = 0
+
+    def _parse(self, content):
+        self.parses += 1
+        return html.fromstring(content)
+
+    def reference(self, content):
+        """Return the shared tree of a reference page. Callers must not modify it."""
+        if not content:
+            return None
+        entry = self._trees.get(content)
+        if entry is None:
+            soup = self._parse(content)
+            # html.fromstring often returns an element below the implied <html>
+            # root; remember where it sits so copies keep the whole document.
+            path = soup.getroottree().getpath(soup)
+            entry = self._trees[content] = (soup, path)
+            self.tree_nbytes += len(content) * TREE_BYTES_PER_CHAR
+            # 刚解析的树在最后，至少保留它
+            while self.budget is not None and self.tree_nbytes > self.budget and len(self._trees) > 1:
+                self._drop_tree(next(iter(self._trees)))
+                self.evictions += 1
+            self._update_peak()
+        else:
+            self._trees.move_to_end(content)
+        return entry[0]
+
+    def _drop_tree(self, content):
+        if self._trees.pop(content, None) is not None:
+            self.tree_nbytes -= len(content) * TREE_BYTES_PER_CHAR
+
+    def _update_peak(self):
+        self.peak_nbytes = max(self.peak_nbytes, self.tree_nbytes + self.index_nbytes)
+
+    def release(self, content):
+        """Forget a reference page that no remaining page is compared with."""
+        self._drop_tree(content)
+        reference_index = self._indexes.pop(content, None)
+        if reference_index is not None:
+            self.index_nbytes -= reference_index.nbytes
+        self._references.discard(content)
+
+    def working(self, content):
+        """Return a tree of the page that the caller is free to modify."""
+        if not content:
+            return None
+        # 索引已建好而树被丢弃的参考页面，直接解析，不再放回缓存
+        if content not in self._trees and (content not in self._references or content in self._indexes):
+            return self._parse(content)
+        self.reference(content)
+        soup, path = self._trees[content]
+        self.copies += 1
+        document = copy.deepcopy(soup.getroottree().getroot())
+        return document.getroottree().xpath(path)[0]
+
+    def index(self, content, label=None):
+        """Return the ReferenceIndex of a reference page, building it on first use."""
+        if not content:
+            return None
+        reference_index = self._indexes.get(content)
+        if reference_index is None:
+            reference_index = self._indexes[content] = build_reference_index(self.reference(content), label, self.index_factory)
+            if reference_index is not None:
+                self.index_nbytes += reference_index.nbytes
+                self._update_peak()
+        return reference_index
@@ -0,0 +1,135 @@
+import logging
+import os
+import shutil
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from clear_io import is_jsonl, iter_pages, write_pages
+from clear_manifest import content_hash, file_hash
+from clear_rules import site_rules_path
+
+# 清洗后写入页面的字段，按 clean_variant 写入的顺序
+CLEANED_FIELDS = ('body_html_new', 'body_new', 'body_html_deleted', 'body_deleted')
+# 只用于统计来源的查询参数，不影响页面内容
+TRACKING_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'spm', 'from')
+
+
+def canonical_url(url):
+    """Return url without what does not change the page it points to.
+
+    http and https, the case of the host, a www. prefix, the default port, a
+    trailing slash, the fragment, tracking parameters and the order of the
+    query parameters are ignored.
+    """
+    if not url:
+        return ''
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').removeprefix('www.')
+    if parts.port and parts.port not in (80, 443):
+        host += f':{parts.port}'
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if key.lower() not in TRACKING_PARAMS))
+    return urlunsplit(('', host, parts.path.rstrip('/'), query, ''))
+
+
+def document_key(company):
+    """Return the key of a page's document: its canonical url, whether it is a homepage and its body_html.
+
+    Pages with the same key are cleaned the same way against the same
+    reference page. Pages without body_html get None and are never
+    deduplicated.
+    """
+    content = company.get('body_html')
+    if not content:
+        return None
+    return content_hash('\0'.join((canonical_url(company.get('url')), str(company.get('p_url') == ''), content)))
+
+
+def find_duplicates(documents):
+    """Return {position: position of its first copy} for documents [(document_key, keys)].
+
+    keys maps every output that writes the page to the key of its reference
+    page; a page is only a duplicate of one written to the same outputs
+    against the same references.
+    """
+    first = {}
+    duplicates = {}
+    for position, (key, keys) in enumerate(documents):
+        if key is None or not keys:
+            continue
+        group = (key, tuple(sorted(keys.items(), key=lambda item: str(item[0]))))
+        if group in first:
+            duplicates[position] = first[group]
+        else:
+            first[group] = position
+    return duplicates
+
+
+def duplicate_page(cleaned, company):
+    """Return what cleaning company gives, given the cleaned page of one of its duplicates."""
+    page = dict(company)
+    for field in CLEANED_FIELDS:
+        if field in cleaned:
+            page[field] = cleaned[field]
+        else:
+            page.pop(field, None)
+    return page
+
+
+def find_duplicate_files(files):
+    """Split site files into the files to process and {duplicate file: the file it is a copy of}.
+
+    Files are copies when their content, their format (JSON or JSON Lines)
+    and their site-specific rules are the same.
+    """
+    first = {}
+    unique = []
+    duplicates = {}
+    for src_file in sorted(files):
+        rules_path = site_rules_path(src_file)
+        site_rules = file_hash(rules_path) if os.path.exists(rules_path) else ''
+        key = (file_hash(src_file), is_jsonl(src_file), site_rules)
+        if key in first:
+            duplicates[src_file] = first[key]
+        else:
+            first[key] = src_file
+            unique.append(src_file)
+    for src_file, original in duplicates.items():
+        logging.info(f"Duplicate file {src_file} is a copy of {original}")
+    return unique, duplicates
+
+
+def copy_outputs(duplicates, folders, output_format, manifests=None):
+    """Write the output of every duplicate file from the output of the file it is a copy of.
+
+    folders maps each output to its dst_folder. The full format is copied as
+    is; compact pages get the name of the duplicate in their source. With
+    manifests, duplicates whose output is up to date are left alone and the
+    others are recorded with the pages of their original. Returns the number
+    of outputs written.
+    """
+    copied = 0
+    for src_file, original in duplicates.items():
+        source_hash = None
+        for output, dst_folder in folders.items():
+            original_file = os.path.join(dst_folder, output_format.file_name(original))
+            dst_file = os.path.join(dst_folder, output_format.file_name(src_file))
+            if not os.path.exists(original_file):
+                continue
+            if manifests is not None:
+                source_hash = source_hash or file_hash(src_file)
+                entry = manifests[output].entry(src_file, dst_file)
+                if entry is not None and entry['hash'] == source_hash:
+                    continue
+            if output_format.compact:
+                site = os.path.basename(src_file)
+                pages = (dict(page, source=dict(page['source'], file=site)) for page in iter_pages(original_file))
+                write_pages(dst_file, pages, output_format)
+            else:
+                tmp_file = dst_file + '.tmp'
+                shutil.copyfile(original_file, tmp_file)
+                os.replace(tmp_file, dst_file)
+            logging.info(f"Copied the output of {original} to {dst_file}")
+            copied += 1
+            if manifests is not None:
+                original_entry = manifests[output].entries.get(os.path.basename(original)) or {}
+                manifests[output].record(src_file, dst_file, source_hash, original_entry.get('pages', ()))
+    return copied
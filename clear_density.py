@@ -0,0 +1,221 @@
+import hashlib
+import logging
+from collections import Counter
+from lxml import etree, html
+from clear_common import BLOCK_TAGS, text_fingerprint
+from clear_template import block_table
+
+try:
+    import numpy as np
+except ImportError:  # 没有安装 numpy 时不能按块特征打分
+    np = None
+
+# 默认阈值：得分低于它的块删除
+DENSITY_THRESHOLD = 0.2
+# 非空白字符达到这个数的块，长度不再扣分
+FULL_CHARS = 200
+# 同一父元素下同类（标签和类名相同）的元素越多，得分越低；这是除数里 log(同类数) 的系数
+REPEAT_WEIGHT = 0.25
+# 深度不超过它的元素（html、body 和页面的最外层元素）不删除
+PROTECTED_DEPTH = 2
+# 文字占页面超过这个比例的块不删除，链接多的首页不至于整页删空
+MAX_SHARE = 0.5
+# 打分的元素：块元素，不含页面的外壳
+SCORED_TAGS = BLOCK_TAGS - {'html', 'body', 'br'}
+# 不算作内容的字符
+WHITESPACE = (0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x20, 0xa0, 0x3000)
+# PageBlocks 的每块一项的列
+COLUMNS = ('positions', 'lasts', 'chars', 'links', 'depths', 'repeats', 'fingerprints')
+
+
+def check_numpy():
+    """Raise ImportError when numpy, which the density stage needs, is not installed."""
+    if np is None:
+        raise ImportError("block density scoring needs numpy (pip install numpy)")
+
+
+class PageBlocks:
+    """The block elements of one page with text, as columns with one entry per block.
+
+    ``positions`` are the elements' positions in document order and ``lasts``
+    those of their last descendants (see clear_common.text_spans); ``chars``
+    counts their non-blank characters and ``links`` those inside <a>;
+    ``depths`` is the depth from the document root, ``repeats`` the number
+    of siblings with the same tag and classes, the element included, and
+    ``fingerprints`` the block keys (see clear_template.block_table).
+    ``key`` is the fingerprint of the page's HTML and ``page_chars`` its
+    non-blank characters.
+    """
+
+    __slots__ = ('key', 'page_chars') + COLUMNS
+
+    def __init__(self, key, page_chars, **columns):
+        self.key = key
+        self.page_chars = page_chars
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def page_blocks(content):
+    """Parse a page and return its PageBlocks, or None for a page without body_html.
+
+    The walk over the elements is the one of clear_template.block_table; the
+    character counts come from prefix sums over the page text, so each is two
+    lookups whatever the size of the block.
+    """
+    if not content:
+        return None
+    text, elements, spans, parents, steps, keys = block_table(html.fromstring(content))
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    solid = ~np.isin(codes, WHITESPACE)
+    span_array = np.array(spans, dtype=np.int64).reshape(-1, 3)
+    # 链接覆盖的文字：每个 <a> 的区间起点加一、终点减一，累加后大于零的位置在链接里
+    anchors = [position for position, element in enumerate(elements) if element.tag == 'a']
+    inside = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.add.at(inside, span_array[anchors, 0], 1)
+    np.add.at(inside, span_array[anchors, 1], -1)
+    linked = solid & (np.cumsum(inside[:-1]) > 0)
+    solid_before = np.concatenate(([0], np.cumsum(solid)))
+    linked_before = np.concatenate(([0], np.cumsum(linked)))
+
+    depths = []
+    for parent in parents:
+        depths.append(0 if parent < 0 else depths[parent] + 1)
+    siblings = Counter(zip(parents, steps))
+    positions = [position for position, element in enumerate(elements) if element.tag in SCORED_TAGS and keys[position] is not None]
+    starts = span_array[positions, 0]
+    ends = span_array[positions, 1]
+    return PageBlocks(
+        text_fingerprint(content), int(solid_before[-1]),
+        positions=np.array(positions, dtype=np.int64),
+        lasts=span_array[positions, 2],
+        chars=solid_before[ends] - solid_before[starts],
+        links=linked_before[ends] - linked_before[starts],
+        depths=np.array([depths[position] for position in positions], dtype=np.int64),
+        repeats=np.array([siblings[parents[position], steps[position]] for position in positions], dtype=np.int64),
+        fingerprints=np.array([keys[position] for position in positions], dtype=np.uint64),
+    )
+
+
+def site_frequency(fingerprints, page_ids, pages):
+    """Return for every block the share of the site's other pages that have the same block, from 0 (only this page) to 1 (all pages)."""
+    if pages < 2:
+        return np.zeros(len(fingerprints))
+    # 每个页面里相同的块只算一次
+    order = np.lexsort((fingerprints, page_ids))
+    sorted_fingerprints = fingerprints[order]
+    sorted_pages = page_ids[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sorted_fingerprints[1:] != sorted_fingerprints[:-1]) | (sorted_pages[1:] != sorted_pages[:-1])
+    distinct, counts = np.unique(sorted_fingerprints[first], return_counts=True)
+    return (counts[np.searchsorted(distinct, fingerprints)] - 1) / (pages - 1)
+
+
+def score_blocks(chars, links, repeats, frequency):
+    """Score blocks from 0 (boilerplate) to 1 (content); every argument is an array with one entry per block.
+
+    Short blocks, link text, blocks repeated among their siblings and blocks
+    found on the other pages of the site all lower the score.
+    """
+    length = np.minimum(1.0, np.log1p(chars) / np.log1p(FULL_CHARS))
+    link_ratio = links / np.maximum(chars, 1)
+    return length * (1 - link_ratio) * (1 - frequency) / (1 + REPEAT_WEIGHT * np.log(np.maximum(repeats, 1)))
+
+
+class BlockFilter:
+    """The low-content blocks to remove from each page of a site, learned from all its pages at once.
+
+    ``drops`` maps the fingerprint of a page's HTML to the positions of its
+    blocks to remove, and those of their last descendants, in document order.
+    """
+
+    def __init__(self, drops, threshold=DENSITY_THRESHOLD):
+        self.drops = drops
+        self.threshold = threshold
+
+    def __len__(self):
+        return sum(len(positions) for positions, _ in self.drops.values())
+
+    def page_hash(self, content):
+        """Hash what the filter removes from a page, for the manifest; '' when it removes nothing."""
+        drop = self.drops.get(text_fingerprint(content)) if content else None
+        return hashlib.blake2b(drop[0].tobytes(), digest_size=8).hexdigest() if drop is not None else ''
+
+    def subset(self, contents):
+        """Return a BlockFilter with only the pages of contents, to send with a batch of them."""
+        keys = {text_fingerprint(content) for content in contents if content}
+        return BlockFilter({key: drop for key, drop in self.drops.items() if key in keys}, self.threshold)
+
+    def remove_matches(self, soup, content, on_remove=None):
+        """Remove the low-content blocks of soup, freshly parsed from content, and return them.
+
+        Blocks inside a removed block and blocks containing soup are left
+        alone. on_remove(element, None) is called before each removal.
+        """
+        drop = self.drops.get(text_fingerprint(content)) if content else None
+        if drop is None:
+            return []
+        root = soup
+        for root in soup.iterancestors():
+            pass
+        # 与 text_spans 相同的文档顺序，只有元素
+        elements = list(root.iter(etree.Element))
+        keep = {soup, *soup.iterancestors()}
+        removed = []
+        skip_to = -1
+        for position, last in zip(drop[0].tolist(), drop[1].tolist()):
+            if position <= skip_to or position >= len(elements):
+                continue
+            element = elements[position]
+            parent = element.getparent()
+            if element in keep or parent is None:
+                continue
+            if on_remove is not None:
+                on_remove(element, None)
+            parent.remove(element)
+            removed.append(element)
+            skip_to = last
+        return removed
+
+
+def learn_filter(tables, threshold=DENSITY_THRESHOLD, label=None):
+    """Score the blocks of every page of a site (PageBlocks, None for pages without body_html) in one batch and return a BlockFilter.
+
+    The columns of all pages are concatenated, so scoring costs a few numpy
+    calls per site whatever its number of pages. A block is removed when
+    its score is below threshold, unless it is one of the outermost elements
+    of the page or holds more than MAX_SHARE of its text.
+    """
+    # 内容相同的页面只算一次，否则它们的块会被当成在多个页面里出现
+    distinct = {}
+    for table in tables:
+        if table is not None and table.key not in distinct:
+            distinct[table.key] = table
+    tables = list(distinct.values())
+    sizes = [len(table) for table in tables]
+    if not sum(sizes):
+        return BlockFilter({}, threshold)
+    columns = {name: np.concatenate([getattr(table, name) for table in tables]) for name in COLUMNS}
+    page_ids = np.repeat(np.arange(len(tables)), sizes)
+    page_chars = np.repeat(np.array([max(table.page_chars, 1) for table in tables]), sizes)
+    frequency = site_frequency(columns['fingerprints'], page_ids, len(tables))
+    scores = score_blocks(columns['chars'], columns['links'], columns['repeats'], frequency)
+    drop = (scores < threshold) & (columns['depths'] > PROTECTED_DEPTH) & (columns['chars'] <= MAX_SHARE * page_chars)
+
+    drops = {}
+    bounds = np.cumsum(sizes)[:-1]
+    for table, page_drop, positions, lasts in zip(tables, np.split(drop, bounds), np.split(columns['positions'], bounds),
+                                                  np.split(columns['lasts'], bounds)):
+        if page_drop.any():
+            drops[table.key] = (positions[page_drop], lasts[page_drop])
+    block_filter = BlockFilter(drops, threshold)
+    logging.info(f"Scored {len(drop)} blocks of {len(tables)} pages of {label}: {len(block_filter)} low-content blocks to remove")
+    return block_filter
+
+
+def learn_density(contents, threshold=DENSITY_THRESHOLD, label=None):
+    """Learn the BlockFilter of a site from the body HTML of its pages."""
+    return learn_filter([page_blocks(content) for content in contents], threshold, label)
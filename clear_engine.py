@@ -0,0 +1,984 @@
+import copy
+import json
+import logging
+import os
+import time
+from multiprocessing import cpu_count
+from lxml import etree, html
+from collections import Counter
+from clear_common import REFERENCE_BUDGET, DocumentCache, normalize_text, raw_block_text, remove_empty_elements, remove_ending
+from clear_density import check_numpy, learn_density
+from clear_dedup import copy_outputs, document_key, duplicate_page, find_duplicate_files, find_duplicates
+from clear_fuzzy import index_factory
+from clear_guard import PageTimeout, WorkerLimits, time_budget
+from clear_hierarchy import PageTree
+from clear_lite import STREAM_MIN_CHARS, clean_streaming
+from clear_io import INPUT_SUFFIXES, PageWriter, iter_pages, resolve_output_format, write_pages
+from clear_manifest import Manifest, content_hash
+from clear_metrics import Metrics, count_nodes, log_metrics
+from clear_profile import Profiling, profiled_metrics, write_profiles
+from clear_rules import BoilerplateRules, log_rule_stats, merge_rule_stats, rules_for_file
+from clear_scheduler import SitePlan, run_files, run_sites
+from clear_store import resolve_store, site_fingerprints
+from clear_template import learn_template
+
+COMMON_FOOTER_RULES = [
+    {"tag": "footer"},
+    {"tag": "div", "class": "footer"},
+    {"tag": "div", "id": "footer"},
+    {"tag": "div", "id": "bottom"},
+    {"tag": "div", "class": "copyright"},
+    {"tag": "div", "id": "copyright"},
+    {"tag": "div", "class": "legal"},
+    {"tag": "div", "id": "legal"}
+]
+
+# clear_simplify 的规则里一直没有 div.legal（id 含 legal 的规则写了两遍）
+SIMPLIFIED_FOOTER_RULES = [rule for rule in COMMON_FOOTER_RULES if rule != {"tag": "div", "class": "legal"}]
+# clear_add_deleted 的规则里也没有 div.legal
+DELETED_FOOTER_RULES = SIMPLIFIED_FOOTER_RULES
+
+# 清洗逻辑变化时加一，之前的输出会在下次运行时全部重新生成
+CLEANING_VERSION = 4
+
+
+class Variant:
+    """The options that make one output variant of the cleaning pipeline.
+
+    hierarchical: compare every page with its parent page (p_url), level by
+    level, instead of comparing homepages (p_url == '') with the first child
+    page and the other pages with the first homepage.
+    ending_window: when truncating the ending shared with the reference page,
+    only look at the last N characters of the page (None looks at up to
+    clear_common.ENDING_BLOCKS text blocks, whatever their length).
+    ending_suffix: the shared ending may take the whole page, i.e. the page
+    may be truncated to nothing when the reference text ends with it.
+    capture_deleted: record what was removed from homepages in
+    body_html_deleted and body_deleted.
+    require_children: pages whose root element has no children come out empty.
+    block_text: write body_new one block element per line with its whitespace
+    collapsed (see clear_common.normalize_text), instead of text_content()
+    with the page's indentation.
+    """
+
+    def __init__(self, name, footer_rules=COMMON_FOOTER_RULES, hierarchical=False, ending_window=None,
+                 ending_suffix=False, capture_deleted=False, require_children=False, block_text=True):
+        self.name = name
+        self.footer_rules = [dict(rule) for rule in footer_rules]
+        self.hierarchical = hierarchical
+        self.ending_window = ending_window
+        self.ending_suffix = ending_suffix
+        self.capture_deleted = capture_deleted
+        self.require_children = require_children
+        self.block_text = block_text
+        # 规则在每个进程导入时编译一次，站点专属规则见 clear_rules.rules_for_file
+        self.rules = BoilerplateRules(self.footer_rules)
+
+    def config(self):
+        """Everything that affects this variant's output, for the manifest."""
+        return {name: value for name, value in vars(self).items() if name != 'rules'}
+
+
+HIERARCHICAL = Variant('hierarchical', hierarchical=True, require_children=True)
+SIMPLIFIED = Variant('simplified', footer_rules=SIMPLIFIED_FOOTER_RULES, ending_window=1000)
+WITH_DELETED = Variant('with_deleted', footer_rules=DELETED_FOOTER_RULES, ending_suffix=True, capture_deleted=True)
+
+VARIANTS = {variant.name: variant for variant in (HIERARCHICAL, SIMPLIFIED, WITH_DELETED)}
+
+
+def resolve_variants(outputs):
+    """Turn {variant or variant name: dst_folder} into ({name: Variant}, {name: dst_folder})."""
+    variants = {}
+    folders = {}
+    for variant, dst_folder in outputs.items():
+        if not isinstance(variant, Variant):
+            variant = VARIANTS[variant]
+        variants[variant.name] = variant
+        folders[variant.name] = dst_folder
+    return variants, folders
+
+
+def remove_common_footers(soup, rules, on_remove=None):
+    """Remove common footer elements and return them."""
+    return rules.remove(soup, on_remove)
+
+
+def remove_similar_elements(parent_index, child_soup, on_remove=None):
+    """Remove elements from child_soup that have similar content as in the reference page indexed by parent_index.
+
+    parent_index can also be a SiteTemplate. Returns the removed elements.
+    """
+    if parent_index is None or child_soup is None:
+        return []
+    return parent_index.remove_matches(child_soup, on_remove)
+
+
+def compare_endings(reference_index, child_soup, window=None, suffix=False, on_remove=None):
+    """Truncate the trailing text blocks that child_soup shares with the ending of the reference page.
+
+    The longest shared run of blocks at the end of both pages is removed (see
+    clear_common.remove_ending). window limits the run to the last window
+    characters of the page; with suffix the run may take the whole page,
+    otherwise its first block is kept. Returns the removed elements.
+    """
+    if reference_index is None or child_soup is None:
+        return []
+    return remove_ending(child_soup, reference_index.ending, window, suffix, on_remove)
+
+
+def copy_tree(soup):
+    """Deep-copy the document containing soup and return soup's copy, or None if soup was detached from it."""
+    root = soup.getroottree().getroot()
+    if soup is not root and root not in soup.iterancestors():
+        return None
+    path = root.getroottree().getpath(soup)
+    return copy.deepcopy(root).getroottree().xpath(path)[0]
+
+
+class Deletion:
+    """One element removed from a page: the stage that removed it, where it was and, once rendered, its HTML and text.
+
+    start and end are the offsets of the element's text in the page text, when
+    the stage computed them (see clear_common.text_spans).
+    """
+
+    __slots__ = ('stage', 'element', 'path', 'start', 'end', 'html', 'text')
+
+    def __init__(self, stage, element, span):
+        self.stage = stage
+        self.element = element
+        self.path = element.getroottree().getpath(element)
+        self.start, self.end = (span[0], span[1]) if span is not None else (None, None)
+        self.html = None
+        self.text = None
+
+    def render(self):
+        if self.html is None:
+            # tostring 带上了元素的 tail，文本也一样，这样和重新解析 HTML 得到的文本相同
+            self.html = html.tostring(self.element, encoding='unicode', method='html')
+            self.text = (self.element.text_content() + (self.element.tail or '')).strip()
+            self.element = None
+        return self.html, self.text
+
+
+class DeletionLog:
+    """The elements removed from soup, in the order they were removed, rendered only when the output needs them.
+
+    A removed element is not touched again by later stages, so it can be
+    serialized at the end, unless it contains soup: soup is still cleaned after
+    being detached together with it. end_stage() renders those right away.
+    """
+
+    def __init__(self, soup, deletions=()):
+        self.soup = soup
+        self.deletions = list(deletions)
+
+    def record(self, stage, element, span):
+        self.deletions.append(Deletion(stage, element, span))
+
+    def end_stage(self):
+        """Render the removed elements that contain soup, before the next stage cleans them."""
+        ancestors = {self.soup, *self.soup.iterancestors()}
+        for deletion in self.deletions:
+            if deletion.element in ancestors:
+                deletion.render()
+
+    def render(self):
+        """Return the HTML and the text of everything removed, in one pass over the deletions."""
+        parts = [deletion.render() for deletion in self.deletions]
+        return ''.join(part[0] for part in parts), ''.join(part[1] for part in parts)
+
+
+def recorder(log, stage):
+    """Return an on_remove callback that records in log the elements removed by stage, or None without a log."""
+    if log is None:
+        return None
+    return lambda element, span: log.record(stage, element, span)
+
+
+def is_homepage(variant, company):
+    return not variant.hierarchical and company.get('p_url') == ''
+
+
+def serialize(soup, block_text=False):
+    """Return the cleaned HTML and text of soup; with block_text, the text of clear_common.normalize_text."""
+    body_html = html.tostring(soup, encoding='unicode', method='html')
+    if block_text:
+        return body_html, normalize_text(raw_block_text(soup))
+    return body_html, soup.text_content().strip()
+
+
+def clean_variant(variant, company, soup, has_children, removed, reference_index, template=None, metrics=None):
+    """Run the stages of one variant that follow footer removal and return its copy of the page.
+
+    removed holds the Deletions of the footer elements already removed from
+    soup; it is only filled for the homepages of variants that capture them.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    page = dict(company)
+    homepage = is_homepage(variant, company)
+    if soup is None or (variant.require_children and not has_children):
+        page['body_html_new'] = ''
+        page['body_new'] = ''
+        if variant.capture_deleted and homepage:
+            page['body_html_deleted'] = ''
+            page['body_deleted'] = ''
+        return page
+
+    # 层级模式只和根元素有子元素的父页面对比
+    if variant.hierarchical and reference_index is not None and not reference_index.has_children:
+        reference_index = None
+    # 有站点模板时用模板代替与参考页面的逐元素对比
+    similar_index = template if template is not None else reference_index
+    deleted = DeletionLog(soup, removed) if variant.capture_deleted and homepage else None
+    if homepage:
+        if reference_index is not None:
+            metrics.call('ending', compare_endings, reference_index, soup, variant.ending_window, variant.ending_suffix,
+                         recorder(deleted, 'ending'))
+            if deleted is not None:
+                deleted.end_stage()
+        metrics.call('similar', remove_similar_elements, similar_index, soup, recorder(deleted, 'similar'))
+        if deleted is not None:
+            deleted.end_stage()
+        metrics.call('prune', remove_empty_elements, soup)
+    elif similar_index is not None:
+        metrics.call('similar', remove_similar_elements, similar_index, soup)
+        metrics.call('prune', remove_empty_elements, soup)
+        # 只有截断了结尾时才可能留下新的空标签
+        if reference_index is not None and metrics.call('ending', compare_endings, reference_index, soup,
+                                                        variant.ending_window, variant.ending_suffix):
+            metrics.call('prune', remove_empty_elements, soup)
+    else:
+        metrics.call('prune', remove_empty_elements, soup)
+
+    page['body_html_new'], page['body_new'] = metrics.call('serialize', serialize, soup, variant.block_text)
+    if variant.capture_deleted:
+        if homepage:
+            page['body_html_deleted'], page['body_deleted'] = metrics.call('serialize', deleted.render)
+        else:
+            # 不记录子页面的删除内容
+            page.pop('body_html_deleted', None)
+            page.pop('body_deleted', None)
+    return page
+
+
+def streamed_variant(variant, company, body_html, body_text, has_children):
+    """Return the copy of a page without reference page that one variant writes, from the output of clean_streaming."""
+    page = dict(company)
+    if variant.require_children and not has_children:
+        body_html = body_text = ''
+    page['body_html_new'] = body_html
+    page['body_new'] = body_text
+    if variant.capture_deleted:
+        page.pop('body_html_deleted', None)
+        page.pop('body_deleted', None)
+    return page
+
+
+def remove_global_boilerplate(soup, boilerplate, on_remove=None):
+    """Remove the blocks that boilerplate (a clear_store.GlobalBoilerplate) knows from other sites and return them."""
+    return boilerplate.remove_matches(soup, on_remove)
+
+
+def remove_low_content(soup, block_filter, content, on_remove=None):
+    """Remove the blocks that block_filter (a clear_density.BlockFilter) scored as low-content in the page content and return them."""
+    return block_filter.remove_matches(soup, content, on_remove)
+
+
+def clean_page(company, keys, references, rules, template=None, variants=VARIANTS, cache=None, site=None, metrics=None,
+               boilerplate_store=None, stream_min_chars=STREAM_MIN_CHARS, page_timeout=None, block_filter=None):
+    """Return {variant name: cleaned page} for every variant in keys, see clean_page_stages, isolating the page's failures.
+
+    A page that takes longer than page_timeout seconds (see
+    clear_guard.time_budget) or raises is cleaned again the cheap way: as if
+    it had no reference page, template, boilerplate store or block filter,
+    i.e. footer rules and pruning only. A page that fails that way too comes out empty.
+    Both are recorded in metrics (see Metrics.add_error), and the other pages
+    of the file are not affected.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    try:
+        with time_budget(page_timeout):
+            return clean_page_stages(company, keys, references, rules, template, variants, cache, site, metrics, boilerplate_store,
+                                     stream_min_chars, block_filter)
+    except Exception as e:
+        kind = 'page_timeouts' if isinstance(e, PageTimeout) else 'page_errors'
+        logging.warning(f"Cleaning {company.get('url')} the cheap way after {type(e).__name__}: {e}")
+        metrics.add_error(kind, site, e, company.get('url'), 'no_reference')
+    try:
+        with time_budget(page_timeout):
+            return clean_page_stages(company, dict.fromkeys(keys), {}, rules, None, variants, None, site, metrics, None, stream_min_chars)
+    except Exception as e:
+        logging.error(f"Writing {company.get('url')} empty after {type(e).__name__}: {e}")
+        metrics.add_error('page_errors', site, e, company.get('url'), 'empty')
+    return {name: clean_variant(variants[name], company, None, False, [], None) for name in keys}
+
+
+def clean_page_stages(company, keys, references, rules, template=None, variants=VARIANTS, cache=None, site=None, metrics=None,
+                      boilerplate_store=None, stream_min_chars=STREAM_MIN_CHARS, block_filter=None):
+    """Parse a page once and return {variant name: cleaned page} for every variant in keys.
+
+    keys maps a variant name to the key of the page's reference page in
+    references (or None), rules maps it to its footer rules. Variants with the
+    same rules share the footer stage and, with boilerplate_store (a
+    clear_store.BoilerplateStore), the removal of the blocks known to repeat
+    across sites; each variant then works on its own copy of the tree. Stage
+    times and the page's counters go to metrics, under site. With
+    block_filter (a clear_density.BlockFilter), the page's low-content blocks
+    are removed first, before the footer rules.
+
+    A page of at least stream_min_chars characters (None: never) that no
+    variant compares with a reference page, a template, the boilerplate
+    store or a block filter, and that is not a homepage whose deletions are captured, is
+    cleaned by clear_lite.clean_streaming instead, without building its
+    whole tree; it gives the same output.
+    """
+    logging.info(f"Processing page: {company.get('url')}")
+    start_time = time.perf_counter()
+    if metrics is None:
+        metrics = Metrics()
+    if cache is None:
+        cache = DocumentCache()
+    content = company.get('body_html')
+    # 每个进程只读一次存储，之后是一次字典查找
+    boilerplate = boilerplate_store.known() if boilerplate_store is not None else None
+    groups = {}
+    for name in keys:
+        groups.setdefault(id(rules[name]), []).append(name)
+    cleaned = {}
+    nodes = nodes_left = 0
+
+    if (stream_min_chars is not None and content and len(content) >= stream_min_chars and template is None and not boilerplate
+            and block_filter is None
+            and all(references.get(keys[name]) is None and not (variants[name].capture_deleted and is_homepage(variants[name], company))
+                    for name in keys)):
+        for group, names in list(groups.items()):
+            block_text = {variants[name].block_text for name in names}
+            if len(block_text) > 1:
+                # 规则相同但文本格式不同的变体一起交给树引擎
+                continue
+            streamed = metrics.call('stream', clean_streaming, content, rules[names[0]], block_text=block_text.pop())
+            if streamed is None:
+                # 流式引擎不能保证结果相同的页面（如规则匹配到页面根元素），交给树引擎
+                continue
+            body_html, body_text, has_children, nodes, group_left = streamed
+            for name in names:
+                cleaned[name] = streamed_variant(variants[name], company, body_html, body_text, has_children)
+                if cleaned[name]['body_html_new']:
+                    nodes_left += group_left
+            del groups[group]
+
+    soup = None
+    if groups:
+        soup = metrics.call('parse', cache.working, content)
+        has_children = soup is not None and len(soup) > 0
+        nodes = count_nodes(soup)
+    # 每组规则一棵树，页面只解析一次，其余的树都从未修改的树复制
+    trees = [soup] + [metrics.call('copy', copy_tree, soup) if soup is not None else None for _ in range(len(groups) - 1)]
+
+    for tree, names in zip(trees, groups.values()):
+        group_rules = rules[names[0]]
+        removed = []
+        if tree is not None:
+            deleted = None
+            if any(variants[name].capture_deleted and is_homepage(variants[name], company) for name in names):
+                deleted = DeletionLog(tree)
+            if block_filter is not None:
+                metrics.call('density', remove_low_content, tree, block_filter, content, recorder(deleted, 'density'))
+                if deleted is not None:
+                    deleted.end_stage()
+            metrics.call('footer', remove_common_footers, tree, group_rules, recorder(deleted, 'footer'))
+            if deleted is not None:
+                deleted.end_stage()
+            if boilerplate:
+                metrics.call('global', remove_global_boilerplate, tree, boilerplate, recorder(deleted, 'global'))
+                if deleted is not None:
+                    deleted.end_stage()
+            if deleted is not None:
+                removed = deleted.deletions
+        for position, name in enumerate(names):
+            variant_tree = tree
+            if tree is not None and position < len(names) - 1:
+                variant_tree = metrics.call('copy', copy_tree, tree)
+                if variant_tree is None:
+                    # 页面根元素本身被页脚规则删除时，重新解析再走一遍
+                    variant_tree = html.fromstring(company.get('body_html'))
+                    if block_filter is not None:
+                        remove_low_content(variant_tree, block_filter, content)
+                    remove_common_footers(variant_tree, group_rules)
+                    if boilerplate:
+                        remove_global_boilerplate(variant_tree, boilerplate)
+            cleaned[name] = clean_variant(variants[name], company, variant_tree, has_children, removed,
+                                          references.get(keys[name]), template, metrics)
+            if cleaned[name]['body_html_new']:
+                nodes_left += count_nodes(variant_tree)
+
+    bytes_in = len(content.encode('utf-8')) if content else 0
+    bytes_out = sum(len(page['body_html_new'].encode('utf-8')) for page in cleaned.values())
+    outputs = len(cleaned)
+    metrics.add_page(site, outputs, bytes_in * outputs, bytes_out, nodes * outputs, nodes * outputs - nodes_left,
+                     time.perf_counter() - start_time)
+    return cleaned
+
+
+def plan_hierarchical(companies):
+    """Return the page positions level by level and {position: reference position} for the hierarchical variant.
+
+    A page is compared with the last page of its parent url, or with its
+    nearest crawled ancestor when its parent was not crawled (see
+    clear_hierarchy.PageTree). Every page is written, parents before their
+    children.
+    """
+    tree = PageTree([(company.get('url'), company.get('p_url')) for company in companies])
+    return tree.levels, tree.parents
+
+
+def plan_flat(companies):
+    """Return the homepage and child page positions and {position: reference position} for the flat variants.
+
+    Homepages are compared with the first child page and child pages with the
+    first homepage, but only when the site has both.
+    """
+    homepages = [position for position, company in enumerate(companies) if company.get('p_url') == '']
+    children = [position for position, company in enumerate(companies) if company.get('p_url')]
+    if not homepages or not children:
+        return [homepages, children], dict.fromkeys(homepages + children)
+    keys = dict.fromkeys(homepages, children[0])
+    keys.update(dict.fromkeys(children, homepages[0]))
+    return [homepages, children], keys
+
+
+def plan_variant(variant, companies):
+    """Return the passes (lists of page positions in file order, written one after the other) and reference keys of a variant."""
+    return plan_hierarchical(companies) if variant.hierarchical else plan_flat(companies)
+
+
+def load_pages(src_file):
+    """Load the pages of a site file, or return None if the file is skipped."""
+    with open(src_file, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            logging.error(f"Failed to decode JSON file {src_file}: {e}")
+            return None
+
+    if not any(company.get('body_html') for company in data.get('data', [])):
+        logging.warning(f"Skipping file {src_file} due to missing body_html")
+        return None
+    return data.get('data', [])
+
+
+def index_reference(cache, company, metrics, site):
+    """Index a reference page with cache, or return None, like for a page without reference, when it cannot be parsed.
+
+    The failure is recorded as a page error of that page; the pages compared
+    with it are cleaned without reference.
+    """
+    try:
+        return metrics.call('index', cache.index, company.get('body_html'), company.get('url'))
+    except etree.LxmlError as e:
+        logging.warning(f"Cannot index the reference page {company.get('url')}: {type(e).__name__}: {e}")
+        metrics.add_error('page_errors', site, e, company.get('url'), 'no_reference')
+        return None
+
+
+def plan_file(src_file, variants=VARIANTS, metrics=None, fuzzy_threshold=None, boilerplate_store=None, reference_budget=REFERENCE_BUDGET,
+              page_timeout=None):
+    """Load a file and return a SitePlan with the pages, order and reference pages of every variant.
+
+    Pages and reference pages are keyed by their position in the file, so a
+    page that is a reference for several variants is parsed and indexed once.
+    Pages that no variant writes stay in the plan for learning the template.
+    With fuzzy_threshold, reference pages also match near-duplicate blocks
+    (see clear_fuzzy.FuzzyIndex). boilerplate_store and page_timeout go to
+    clean_page with the other options. Pages with the same canonical url and body_html as an
+    earlier page written to the same outputs are marked as its duplicates.
+    The parsed trees of the reference pages are kept within reference_budget
+    bytes (see DocumentCache).
+    """
+    if metrics is None:
+        metrics = Metrics()
+    companies = metrics.call('load', load_pages, src_file)
+    if companies is None:
+        return None
+    return plan_pages(src_file, companies, variants, metrics, fuzzy_threshold, boilerplate_store, reference_budget, page_timeout=page_timeout)
+
+
+def plan_pages(src_file, companies, variants=VARIANTS, metrics=None, fuzzy_threshold=None, boilerplate_store=None,
+               reference_budget=REFERENCE_BUDGET, rules=None, page_timeout=None):
+    """plan_file for pages already loaded, e.g. sent to clear_service; src_file names the site.
+
+    rules maps each variant name to its footer rules; by default the rules of
+    the variant, extended with the site-specific rule file of src_file.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    keys = {}
+    orders = {}
+    groups = None
+    for name, variant in variants.items():
+        passes, variant_keys = plan_variant(variant, companies)
+        if variant.hierarchical and groups is None:
+            # 和同一个父页面对比的页面分在同一批，少传参考页面
+            groups = {position: key for position, key in variant_keys.items() if key is not None}
+        orders[name] = [position for positions in passes for position in positions]
+        for position in orders[name]:
+            keys.setdefault(position, {})[name] = variant_keys[position]
+
+    # 只有参考页面需要保留一份未修改的解析结果
+    reference_positions = sorted({key for page_keys in keys.values() for key in page_keys.values() if key is not None})
+    cache = DocumentCache((companies[position].get('body_html') for position in reference_positions), index_factory(fuzzy_threshold),
+                          reference_budget)
+    references = {}
+    reference_hashes = {}
+    for position in reference_positions:
+        company = companies[position]
+        references[position] = index_reference(cache, company, metrics, os.path.basename(src_file))
+        reference_hashes[position] = content_hash(company.get('body_html') or '')
+
+    pages = [(company, keys.get(position, {})) for position, company in enumerate(companies)]
+    duplicates = find_duplicates([(document_key(company), page_keys) for company, page_keys in pages])
+    if rules is None:
+        rules = {name: rules_for_file(variant.rules, src_file) for name, variant in variants.items()}
+    options = {'variants': variants, 'site': os.path.basename(src_file), 'boilerplate_store': boilerplate_store, 'page_timeout': page_timeout}
+    return SitePlan(src_file, pages, orders, references, rules, options, cache, reference_hashes, duplicates, groups)
+
+
+def process_file(src_file, outputs, stream=False, template_threshold=None, metrics=None, output_format=None, fuzzy_threshold=None,
+                 boilerplate_store=None, site_blocks=None, reference_budget=REFERENCE_BUDGET, page_timeout=None, density_threshold=None):
+    """Process a file into every variant of outputs ({variant or name: dst_folder}) and return the footer rule stats.
+
+    Each page is parsed once for all variants. With template_threshold, a
+    SiteTemplate of the blocks found in at least that share of the pages is
+    learned first from all pages of the file and used to clean every page.
+    With stream=True the variants are written one after the other, each
+    reading the file page by page. Stage times and per-site counters are
+    added to metrics. Pages are written in output_format (a
+    clear_io.OutputFormat or its name, FULL by default). With fuzzy_threshold,
+    blocks nearly the same as a block of the reference page are removed too.
+
+    With boilerplate_store (a clear_store.BoilerplateStore or its path), the
+    blocks it knows to repeat across sites are removed first. The fingerprints
+    of the site's blocks are added to site_blocks ({site: set}) when given,
+    for BoilerplateStore.update at the end of the run.
+
+    Reference pages are held as their ReferenceIndex; their parsed trees stay
+    within reference_budget bytes, and both are dropped as soon as no
+    remaining page is compared with them. The peak is logged per file.
+
+    A page that takes longer than page_timeout seconds, or fails, is cleaned
+    the cheap way instead and recorded in metrics (see clean_page).
+
+    With density_threshold, the blocks of all pages of the file are scored
+    first in one batch (see clear_density.learn_filter) and the blocks
+    scoring below it are removed from every page.
+    """
+    logging.info(f"Processing file: {src_file}")
+    if metrics is None:
+        metrics = Metrics()
+    output_format = resolve_output_format(output_format)
+    boilerplate_store = resolve_store(boilerplate_store)
+    variants, folders = resolve_variants(outputs)
+    if stream:
+        stats = [process_file_streaming(src_file, folders[name], variant, template_threshold, metrics, output_format, fuzzy_threshold,
+                                        boilerplate_store, site_blocks, page_timeout, density_threshold)
+                 for name, variant in variants.items()]
+        return None if None in stats else merge_rule_stats(stats)
+
+    plan = plan_file(src_file, variants, metrics, fuzzy_threshold, boilerplate_store, reference_budget, page_timeout)
+    if plan is None:
+        return None
+    if site_blocks is not None:
+        site_blocks.setdefault(os.path.basename(src_file), set()).update(site_fingerprints(plan.references.values()))
+    for rules in plan.distinct_rules():
+        rules.reset_stats()
+
+    template = None
+    if template_threshold:
+        contents = (company.get('body_html') for company, _ in plan.pages)
+        template = metrics.call('template', learn_template, contents, template_threshold, src_file)
+    block_filter = None
+    if density_threshold:
+        contents = (company.get('body_html') for company, _ in plan.pages)
+        block_filter = metrics.call('features', learn_density, contents, density_threshold, src_file)
+
+    # 每个参考页面还要和多少个页面对比，减到0就释放
+    remaining = Counter(key for _, keys in plan.pages for key in keys.values() if key is not None)
+    cleaned = []
+    for position, (company, keys) in enumerate(plan.pages):
+        original = plan.duplicates.get(position)
+        if original is not None:
+            # 重复页面直接复制原页面的清洗结果
+            cleaned.append({name: duplicate_page(page, company) for name, page in cleaned[original].items()})
+            metrics.increment('duplicate_pages', len(keys))
+        elif keys:
+            cleaned.append(clean_page(company, keys, plan.references, plan.rules, template, cache=plan.cache, metrics=metrics,
+                                      block_filter=block_filter, **plan.options))
+        else:
+            cleaned.append(None)
+        for key in keys.values():
+            if key is not None:
+                remaining[key] -= 1
+                if not remaining[key]:
+                    plan.release(key)
+    log_reference_memory(src_file, plan.cache.peak_nbytes, plan.cache.parses, plan.cache.evictions)
+    for name, order in plan.orders.items():
+        dst_file = os.path.join(folders[name], output_format.file_name(src_file))
+        pages = [output_format.page(cleaned[position][name], src_file, position) for position in order]
+        metrics.call('write', write_pages, dst_file, pages, output_format)
+        logging.info(f"Processed and saved: {dst_file}")
+    return merge_rule_stats(rules.stats() for rules in plan.distinct_rules())
+
+
+def log_reference_memory(src_file, peak_nbytes, parses=None, evictions=0):
+    """Log the most memory the reference pages of a file took at any one time."""
+    details = f" ({parses} parses, {evictions} trees evicted)" if parses is not None else ''
+    logging.info(f"Peak reference memory for {src_file}: {peak_nbytes / 1024:.1f} KiB{details}")
+
+
+def timed_pages(src_file, metrics):
+    """Like iter_pages, recording the time spent reading each page under 'load'."""
+    pages = iter_pages(src_file)
+    while True:
+        start_time = time.perf_counter()
+        company = next(pages, None)
+        metrics.observe('load', time.perf_counter() - start_time)
+        if company is None:
+            return
+        yield company
+
+
+def process_file_streaming(src_file, dst_folder, variant, template_threshold=None, metrics=None, output_format=None,
+                           fuzzy_threshold=None, boilerplate_store=None, site_blocks=None, page_timeout=None, density_threshold=None):
+    """Process a file into one variant page by page, writing each cleaned page as soon as it is done.
+
+    The first pass only reads url/p_url to plan the order; the hierarchical
+    variant then makes one more pass per level, the flat variants one to read
+    their two reference pages, one for the homepages and one for the other
+    pages. Only the ReferenceIndex of the reference pages that remaining
+    pages are compared with, and the cleaned pages that have duplicates later
+    in the file, stay in memory; the output is identical to the non-streaming
+    mode. page_timeout goes to clean_page; with density_threshold one more
+    pass scores the blocks of every page (see process_file). Returns the
+    footer rule stats, or None if the file was not saved.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    output_format = resolve_output_format(output_format)
+    boilerplate_store = resolve_store(boilerplate_store)
+    rules = rules_for_file(variant.rules, src_file)
+    rules.reset_stats()
+    try:
+        links = []
+        documents = []
+        has_body_html = False
+        for company in timed_pages(src_file, metrics):
+            links.append({'url': company.get('url'), 'p_url': company.get('p_url')})
+            documents.append(document_key(company))
+            has_body_html = has_body_html or bool(company.get('body_html'))
+
+        if not has_body_html:
+            logging.warning(f"Skipping file {src_file} due to missing body_html")
+            return None
+
+        passes, keys = plan_variant(variant, links)
+
+        template = None
+        if template_threshold:
+            contents = (company.get('body_html') for company in iter_pages(src_file))
+            template = metrics.call('template', learn_template, contents, template_threshold, src_file)
+        block_filter = None
+        if density_threshold:
+            contents = (company.get('body_html') for company in iter_pages(src_file))
+            block_filter = metrics.call('features', learn_density, contents, density_threshold, src_file)
+
+        reference_positions = {key for key in keys.values() if key is not None}
+        # 参考页面要建索引，总是清洗
+        duplicates = {position: original for position, original in
+                      find_duplicates([(document, {variant.name: keys[position]} if position in keys else {})
+                                       for position, document in enumerate(documents)]).items()
+                      if position not in reference_positions}
+        # 有重复页面的原页面，清洗结果留到重复页面写完
+        originals = dict.fromkeys(set(duplicates.values()))
+        # 每个参考页面还要和多少个页面对比，减到0就释放它的索引
+        remaining = Counter(key for key in keys.values() if key is not None)
+        references = {}
+        reference_nbytes = peak_nbytes = 0
+        released_blocks = set()
+        if not variant.hierarchical and reference_positions:
+            # 主页要和第一个子页面对比，所以先读出参考页面；读到就停
+            for position, company in enumerate(timed_pages(src_file, metrics)):
+                if position in reference_positions:
+                    reference_cache = DocumentCache(index_factory=index_factory(fuzzy_threshold))
+                    references[position] = index_reference(reference_cache, company, metrics, os.path.basename(src_file))
+                    reference_nbytes += references[position].nbytes if references[position] is not None else 0
+                    if len(references) == len(reference_positions):
+                        break
+            peak_nbytes = reference_nbytes
+
+        dst_file = os.path.join(dst_folder, output_format.file_name(src_file))
+        with PageWriter(dst_file, output_format=output_format) as writer:
+            for positions in passes:
+                pass_positions = set(positions)
+                for position, company in enumerate(timed_pages(src_file, metrics)):
+                    if position not in pass_positions:
+                        continue
+                    if originals.get(duplicates.get(position)) is not None:
+                        page = duplicate_page(originals[duplicates[position]], company)
+                        metrics.increment('duplicate_pages')
+                    else:
+                        cache = None
+                        if position in reference_positions and position not in references and remaining[position]:
+                            # 层级模式下父页面总在子页面之前处理，到这里再建索引
+                            cache = DocumentCache([company.get('body_html')], index_factory(fuzzy_threshold))
+                            references[position] = index_reference(cache, company, metrics, os.path.basename(src_file))
+                            reference_nbytes += references[position].nbytes if references[position] is not None else 0
+                            peak_nbytes = max(peak_nbytes, reference_nbytes)
+                        page = clean_page(company, {variant.name: keys[position]}, references, {variant.name: rules}, template,
+                                          {variant.name: variant}, cache, os.path.basename(src_file), metrics,
+                                          boilerplate_store, page_timeout=page_timeout, block_filter=block_filter)[variant.name]
+                        if position in originals:
+                            originals[position] = page
+                    metrics.call('write', writer.write, output_format.page(page, src_file, position))
+                    key = keys[position]
+                    if key is not None:
+                        remaining[key] -= 1
+                        if not remaining[key] and key in references:
+                            reference_index = references.pop(key)
+                            if reference_index is not None:
+                                reference_nbytes -= reference_index.nbytes
+                                if site_blocks is not None:
+                                    released_blocks.update(reference_index.fingerprints)
+    except json.JSONDecodeError as e:
+        logging.error(f"Failed to decode JSON file {src_file}: {e}")
+        return None
+
+    if site_blocks is not None:
+        site_blocks.setdefault(os.path.basename(src_file), set()).update(released_blocks, site_fingerprints(references.values()))
+    log_reference_memory(f"{src_file} ({variant.name})", peak_nbytes)
+    logging.info(f"Processed and saved: {dst_file}")
+    return rules.stats()
+
+
+def process_site(src_file, outputs, stream=False, template_threshold=None, output_format=None, fuzzy_threshold=None,
+                 boilerplate_store=None, page_timeout=None, density_threshold=None, profiling=None):
+    """process_file for a worker of clear_scheduler.run_files.
+
+    Returns (rule stats, Metrics, {site: block fingerprints}), or None if the
+    file was not saved. When profiling (a clear_profile.Profiling) picks the
+    file, all its stages are profiled and the Profile is in the Metrics.
+    """
+    profile = profiling.target(src_file) if profiling is not None else None
+    metrics = profiled_metrics(profile)
+    site_blocks = {}
+    try:
+        rule_stats = process_file(src_file, outputs, stream, template_threshold, metrics, output_format, fuzzy_threshold,
+                                  boilerplate_store, site_blocks, page_timeout=page_timeout, density_threshold=density_threshold)
+    finally:
+        if profile is not None:
+            metrics.finish()
+    return None if rule_stats is None else (rule_stats, metrics, site_blocks)
+
+
+def process_json_files_in_folder(src_folder, outputs, max_processes=None, stream=False, incremental=True, template_threshold=None,
+                                 metrics_json=None, metrics_prom=None, output_format=None, fuzzy_threshold=None, boilerplate_store=None,
+                                 reference_budget=REFERENCE_BUDGET, limits=None, error_report=None, density_threshold=None, profiling=None,
+                                 refresh_boilerplate=False):
+    """Process all JSON files in a folder into every variant of outputs ({variant or name: dst_folder}).
+
+    By default pages are cleaned in batches spread over all processes, see
+    clear_scheduler.run_sites; each page is parsed once for all variants. With
+    stream=True each process handles whole files, reading and writing pages
+    one at a time, and JSON Lines site files (*_hp.jsonl) are picked up as
+    well.
+
+    With incremental=True a manifest in each dst_folder records what was
+    written, and files and pages that did not change since the last run are
+    reused.
+
+    With template_threshold (e.g. clear_template.TEMPLATE_THRESHOLD), pages are
+    cleaned with a per-site template instead of the reference-page comparison.
+    With fuzzy_threshold (e.g. clear_fuzzy.FUZZY_THRESHOLD), the comparison
+    with the reference page also removes near-duplicate blocks.
+    With density_threshold (e.g. clear_density.DENSITY_THRESHOLD), the blocks
+    of all pages of each site are scored together on their length, link
+    text, depth, repetition among siblings and frequency across the site,
+    and the low-content ones (navigation, sidebars) are removed; this needs
+    numpy.
+
+    With boilerplate_store (a clear_store.BoilerplateStore or the path of its
+    SQLite file), the blocks of the store's snapshot, those found on at least
+    clear_store.MIN_SITES sites in earlier runs, are removed from every page
+    before the per-site stages; the blocks of the sites processed in this run
+    are added to the store in one transaction at the end. The snapshot is
+    taken again at the start of the run with refresh_boilerplate=True or
+    incremental=False, and only then; an incremental run re-cleans the files
+    cleaned with an older snapshot only when the new one differs.
+
+    Files with the same content are processed once and their output is
+    copied to the other files; pages of a file with the same canonical url
+    and body_html are cleaned once (see clear_dedup). The number of duplicate
+    files and of duplicate pages (summed over the outputs) is reported with
+    the metrics.
+
+    The parsed trees of the reference pages of a file are kept within
+    reference_budget bytes (None for no limit); the peak memory taken by the
+    references of each file is logged.
+
+    The per-stage times and per-site counters of all workers are merged and
+    returned as one Metrics, and written as JSON to metrics_json and in the
+    Prometheus text format to metrics_prom when given.
+
+    output_format (a clear_io.OutputFormat or its name) chooses how pages are
+    written: 'full' keeps the indented files with the raw body and
+    body_html, 'compact' writes only the cleaned fields and a reference to the
+    source page, 'compact_gzip' compresses them as well.
+
+    limits (a clear_guard.WorkerLimits, its defaults when None) bounds the
+    time of each page and the life of each worker process: a page over its
+    budget, or that fails, is cleaned the cheap way (see clean_page); workers
+    are replaced after a number of tasks or when their memory grows past a
+    limit. A file that fails, whose batch is lost with a crashed worker, or
+    that runs past limits.file_timeout in streaming mode, is not written and is retried by the next incremental run; the other
+    files go on. Every failure and fallback is written as JSON to
+    error_report when given, and counted in the metrics.
+
+    profiling (a clear_profile.Profiling, or the folder to write to, which
+    profiles every file) samples the stacks and traces the Python
+    allocations of the stages of the files it picks, by name or by sample
+    rate; for each of them <site>.folded, collapsed stacks for a flame graph,
+    and <site>.alloc.txt, the peak allocations of each stage and the lines
+    holding the most memory, are written to its folder. With None nothing is
+    profiled and the stages run as without it.
+    """
+    if limits is None:
+        limits = WorkerLimits()
+    if isinstance(profiling, str):
+        profiling = Profiling(profiling, rate=1.0)
+    if density_threshold:
+        check_numpy()
+    output_format = resolve_output_format(output_format)
+    boilerplate_store = resolve_store(boilerplate_store)
+    if boilerplate_store is not None and (refresh_boilerplate or not incremental):
+        boilerplate_store.refresh()
+    boilerplate_hash = boilerplate_store.known().hash if boilerplate_store is not None else None
+    variants, folders = resolve_variants(outputs)
+    for dst_folder in folders.values():
+        if not os.path.exists(dst_folder):
+            os.makedirs(dst_folder)
+
+    suffixes = INPUT_SUFFIXES if stream else '_hp.json'
+    files = [os.path.join(src_folder, filename) for filename in os.listdir(src_folder) if filename.endswith(suffixes)]
+    # 内容相同的文件只处理一次，输出复制给其余的
+    files, duplicate_files = find_duplicate_files(files)
+
+    manifests = None
+    if incremental:
+        manifests = {name: Manifest(folders[name], [variant.config(), CLEANING_VERSION, template_threshold, output_format.config(),
+                                                   fuzzy_threshold, boilerplate_hash, density_threshold])
+                     for name, variant in variants.items()}
+    start_time = time.time()
+    # 本次处理的各站点的块指纹，最后一次性写入存储
+    site_blocks = {}
+
+    if stream:
+        # 每个进程处理整个文件；预设变体按名字传给进程，站点专属规则的缓存才能命中
+        keys = {name: name if VARIANTS.get(name) is variant else variant for name, variant in variants.items()}
+        stream_outputs = {keys[name]: dst_folder for name, dst_folder in folders.items()}
+        stream_manifests = {keys[name]: manifest for name, manifest in manifests.items()} if manifests else None
+        schedule_stats = run_files(files, process_site,
+                                   (stream, template_threshold, output_format, fuzzy_threshold, boilerplate_store, limits.page_timeout,
+                                    density_threshold, profiling),
+                                   stream_outputs, max_processes, stream_manifests, output_format, limits)
+        site_blocks = schedule_stats.site_blocks
+        processes = max_processes or min(len(files), cpu_count())
+    else:
+        plan_metrics = Metrics()
+
+        def plan_variants(src_file, names):
+            plan = plan_file(src_file, {name: variants[name] for name in names}, plan_metrics, fuzzy_threshold, boilerplate_store,
+                             reference_budget, limits.page_timeout)
+            if plan is None:
+                return None
+            if boilerplate_store is not None:
+                site_blocks.setdefault(os.path.basename(src_file), set()).update(site_fingerprints(plan.references.values()))
+            log_reference_memory(src_file, plan.cache.peak_nbytes, plan.cache.parses, plan.cache.evictions)
+            # 页面在工作进程里解析，计划排队时不必保留参考页面的解析树
+            plan.cache = None
+            return plan
+
+        # 大站点拆成页面批次，分摊到所有进程
+        schedule_stats = run_sites(files, plan_variants, clean_page, folders, max_processes,
+                                   manifests=manifests, template_threshold=template_threshold, output_format=output_format, limits=limits,
+                                   density_threshold=density_threshold, profiling=profiling)
+        schedule_stats.metrics.merge(plan_metrics)
+        processes = max_processes or cpu_count()
+    copy_outputs(duplicate_files, folders, output_format, manifests)
+    schedule_stats.metrics.increment('duplicate_files', len(duplicate_files))
+    total_time = schedule_stats.busy_time
+    total_files = schedule_stats.files
+    avg_time_per_file = total_time / total_files if total_files > 0 else 0
+
+    end_time = time.time()
+    total_elapsed_time = end_time - start_time
+
+    schedule_stats.log(total_elapsed_time, processes)
+    logging.info(f"Total processing time (including waiting): {total_elapsed_time:.2f} seconds")
+    logging.info(f"Total processing time (actual): {total_time:.2f} seconds")
+    logging.info(f"Number of files processed: {total_files}")
+    logging.info(f"Average time per file: {avg_time_per_file:.2f} seconds")
+    log_rule_stats(merge_rule_stats(schedule_stats.rule_stats))
+    log_metrics(schedule_stats.metrics)
+    if metrics_json:
+        schedule_stats.metrics.write_json(metrics_json)
+    if metrics_prom:
+        schedule_stats.metrics.write_prometheus(metrics_prom)
+    if schedule_stats.metrics.errors:
+        logging.warning(f"{len(schedule_stats.metrics.errors)} pages or files failed or were cleaned the cheap way"
+                        + (f", see {error_report}" if error_report else ''))
+    if error_report:
+        schedule_stats.metrics.write_errors(error_report)
+    if profiling is not None:
+        write_profiles(schedule_stats.metrics.profiles, profiling.folder)
+    if boilerplate_store is not None:
+        boilerplate_store.update(site_blocks)
+    return schedule_stats.metrics
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    src_folder = 'info'  # 请将此处替换为包含JSON文件的源文件夹路径
+    # 需要的变体及各自的目标文件夹，不需要的变体删掉即可
+    outputs = {
+        'hierarchical': 'test_output',
+        'simplified': 'test_output2',
+        'with_deleted': 'test_output3',
+    }
+    max_processes = None  # 可选：设置为None时，使用全部CPU，否则设置为你想要的最大进程数量
+    stream = False  # 可选：设置为True时逐页读写，适合内存较小的机器处理大文件
+    incremental = True  # 可选：设置为False时忽略上次运行的结果，全部重新处理
+    template_threshold = None  # 可选：设置为0到1之间的数（如0.5）时，按站点模板去除重复出现的块
+    metrics_json = None  # 可选：各阶段耗时和各站点统计的JSON报告路径，如'metrics.json'
+    metrics_prom = None  # 可选：Prometheus文本格式的指标文件路径，如'clear.prom'
+    output_format = 'full'  # 可选：'compact'只写清洗结果和来源页面位置，'compact_gzip'再用gzip压缩
+    fuzzy_threshold = None  # 可选：设置为0到1之间的数（如0.8）时，与参考页面近似重复的块也删除
+    boilerplate_store = None  # 可选：跨站点模板库的SQLite文件路径，如'boilerplate.sqlite'，出现在多个站点的块直接删除
+    refresh_boilerplate = False  # 可选：设置为True时按模板库的最新计数更新要删除的块，快照有变化的输出会全部重新清洗
+    reference_budget = 256 << 20  # 可选：每个文件的参考页面解析树最多占用的内存（字节），None为不限制
+    page_timeout = 30.0  # 可选：每个页面的时间预算（秒），超时后只按页脚规则清洗，None为不限制
+    max_tasks = 500  # 可选：每个工作进程执行多少个任务后换新进程，None为不换
+    max_rss_mb = 4096  # 可选：工作进程的内存超过多少MB时换掉进程池，None为不限制
+    file_timeout = 3600.0  # 可选：流式模式下每个文件的时间上限（秒），超时的文件记为失败并换掉进程池，None为不限制
+    error_report = 'errors.json'  # 可选：失败和降级清洗的页面、文件的JSON报告路径，None为不写
+    density_threshold = None  # 可选：设置为0到1之间的数（如0.2）时，按块的长度、链接比例等打分，删除得分低的块（需要numpy）
+    profile_files = []  # 可选：要剖析的站点文件名，如['example_hp.json']，各阶段的采样调用栈和内存分配写到profile_folder
+    profile_rate = 0.0  # 可选：按文件名哈希抽样剖析的文件比例（0到1），0为只剖析profile_files
+    profile_folder = 'profiles'  # 剖析结果的文件夹：<站点>.folded可直接用flamegraph.pl或speedscope画火焰图
+
+    process_json_files_in_folder(src_folder, outputs, max_processes, stream, incremental, template_threshold, metrics_json, metrics_prom,
+                                 output_format, fuzzy_threshold, boilerplate_store, reference_budget,
+                                 WorkerLimits(page_timeout, max_tasks, max_rss_mb, file_timeout), error_report, density_threshold,
+                                 Profiling(profile_folder, profile_files, profile_rate) if profile_files or profile_rate else None,
+                                 refresh_boilerplate)
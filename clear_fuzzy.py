@@ -0,0 +1,171 @@
+import functools
+import sys
+import time
+from itertools import accumulate, repeat
+from clear_common import ReferenceIndex, remove_blocks, text_fingerprint, text_spans
+
+# 默认相似度阈值：块的文字片段集合的 Jaccard 相似度估计值不低于它就算近似重复
+FUZZY_THRESHOLD = 0.8
+# 文字片段的长度（字符），中文没有空格分词，所以去掉空白后按字符切
+SHINGLE_SIZE = 4
+# 签名的桶数，以及 LSH 分段：16段，每段4个桶
+SIGNATURE_SIZE = 64
+BANDS = 16
+ROWS = SIGNATURE_SIZE // BANDS
+# 太短的块签名不可靠，只做精确匹配
+MIN_FUZZY_CHARS = 20
+# 太长的块一般是包含正文的容器，只做精确匹配，以免整页被当作近似重复删掉
+MAX_FUZZY_CHARS = 2000
+# 空桶的值，比任何64位哈希都大
+EMPTY = 1 << 64
+# 片段哈希的缓存上限，同一站点的页面大量共用片段
+SHINGLE_CACHE_SIZE = 1 << 20
+
+_shingle_hashes = {}
+
+
+def compact(text):
+    """Return text without whitespace, which is what blocks are compared on."""
+    return ''.join(text.split())
+
+
+def compact_offsets(text):
+    """Return the whitespace-free text and the number of whitespace characters before every offset of text.
+
+    Offset i of text is offset i - spaces[i] of the whitespace-free text.
+    """
+    return compact(text), list(accumulate(map(str.isspace, text), initial=0))
+
+
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    """Return the hash of the shingle starting at every offset of text, hashing each distinct shingle once per process."""
+    if len(_shingle_hashes) > SHINGLE_CACHE_SIZE:
+        _shingle_hashes.clear()
+    shingles = [text[start:start + size] for start in range(max(1, len(text) - size + 1))]
+    hashes = list(map(_shingle_hashes.get, shingles))
+    if None in hashes:
+        for shingle, value in zip(shingles, hashes):
+            if value is None:
+                _shingle_hashes[shingle] = text_fingerprint(shingle)
+        hashes = list(map(_shingle_hashes.get, shingles))
+    return hashes
+
+
+def range_signature(hashes, start, end, size=SHINGLE_SIZE):
+    """Return the one-permutation MinHash signature of the shingles inside text[start:end], given shingle_hashes(text).
+
+    Every shingle goes to the bucket given by its hash and a bucket keeps its
+    smallest hash, or EMPTY. Two texts have the same value in a non-empty
+    bucket with a probability equal to the Jaccard similarity of their
+    shingle sets.
+    """
+    values = sorted(set(hashes[start:max(start + 1, end - size + 1)]), reverse=True)
+    # 从大到小写入字典，每个桶最后留下的就是最小值
+    buckets = dict(zip(map(SIGNATURE_SIZE.__rmod__, values), values))
+    return tuple(map(buckets.get, range(SIGNATURE_SIZE), repeat(EMPTY)))
+
+
+def similarity(first, second):
+    """Estimate the Jaccard similarity of two texts from their signatures."""
+    same = used = 0
+    for a, b in zip(first, second):
+        if a != EMPTY or b != EMPTY:
+            used += 1
+            same += a == b
+    return same / used if used else 0.0
+
+
+def band_keys(signature):
+    """Return the LSH keys of a signature, one per band, leaving out the bands with only empty buckets."""
+    keys = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS:(band + 1) * ROWS]
+        # 短文本的很多桶是空的，全空的段会让所有短块互相成为候选
+        if rows.count(EMPTY) < ROWS:
+            keys.append((band, rows))
+    return keys
+
+
+class FuzzyIndex(ReferenceIndex):
+    """A ReferenceIndex that also matches blocks whose text is nearly the same as a block of the reference page.
+
+    Blocks of MIN_FUZZY_CHARS to MAX_FUZZY_CHARS characters get a MinHash
+    signature, stored in a locality-sensitive hash index: one bucket per band
+    of the signature. A block of another page is looked up in the buckets of
+    its own bands only, so the cost does not grow with the number of blocks of
+    the reference, and the candidates are kept when their estimated similarity
+    is at least threshold. A footer whose date, visit counter or phone number
+    changed is then removed like an exact match. Exact matches are still
+    checked first.
+    """
+
+    def __init__(self, soup, threshold=FUZZY_THRESHOLD):
+        super().__init__(soup)
+        start_time = time.perf_counter()
+        self.threshold = threshold
+        self.signatures = []
+        self.buckets = {}
+        text, _, spans = text_spans(soup)
+        text, spaces = compact_offsets(text)
+        hashes = shingle_hashes(text)
+        seen = set()
+        for start, end, _ in spans:
+            start, end = start - spaces[start], end - spaces[end]
+            block = text[start:end]
+            if MIN_FUZZY_CHARS <= len(block) <= MAX_FUZZY_CHARS and block not in seen:
+                seen.add(block)
+                block_signature = range_signature(hashes, start, end)
+                for key in band_keys(block_signature):
+                    self.buckets.setdefault(key, []).append(len(self.signatures))
+                self.signatures.append(block_signature)
+        self.build_time += time.perf_counter() - start_time
+        self.nbytes += (sys.getsizeof(self.buckets) + sum(sys.getsizeof(ids) for ids in self.buckets.values())
+                        + len(self.signatures) * (sys.getsizeof(()) + SIGNATURE_SIZE * 8))
+
+    def candidates(self, block_signature):
+        """Return the ids of the reference blocks that share at least one band with block_signature."""
+        ids = set()
+        for key in band_keys(block_signature):
+            ids.update(self.buckets.get(key, ()))
+        return ids
+
+    def is_near(self, block_signature):
+        """Return whether the block with this signature is a near duplicate of a block of the reference."""
+        return any(similarity(block_signature, self.signatures[index]) >= self.threshold
+                   for index in self.candidates(block_signature))
+
+    def remove_matches(self, soup, on_remove=None):
+        """Remove elements of soup whose text appears in the reference page, exactly or nearly.
+
+        Same traversal as ReferenceIndex.remove_matches. The shingles of the
+        page are hashed once, so the signature of a block only sorts the hashes
+        of its own range; nested elements with the same text are looked up once.
+        """
+        text, elements, spans = text_spans(soup)
+        compact_text, spaces = compact_offsets(text)
+        hashes = shingle_hashes(compact_text)
+        near = {}
+
+        def is_match(position):
+            start, end, _ = spans[position]
+            element_text = text[start:end].strip()
+            if not element_text:
+                return False
+            if text_fingerprint(element_text) in self.fingerprints:
+                return True
+            start, end = start - spaces[start], end - spaces[end]
+            if not MIN_FUZZY_CHARS <= end - start <= MAX_FUZZY_CHARS:
+                return False
+            block = compact_text[start:end]
+            if block not in near:
+                near[block] = self.is_near(range_signature(hashes, start, end))
+            return near[block]
+
+        return remove_blocks(soup, elements, spans, is_match, on_remove)
+
+
+def index_factory(threshold=None):
+    """Return what builds the index of a reference page: ReferenceIndex, or FuzzyIndex with threshold."""
+    if threshold is None:
+        return ReferenceIndex
+    return functools.partial(FuzzyIndex, threshold=threshold)
@@ -0,0 +1,175 @@
+import logging
+import os
+import signal
+import threading
+import weakref
+from contextlib import contextmanager
+from multiprocessing import Pool, active_children
+
+# 每个页面的时间预算（秒），超时后按没有参考页面的方式重新清洗
+PAGE_TIMEOUT = 30.0
+# 每个工作进程最多执行的任务数，之后换新进程，lxml 占用的内存只有进程退出才归还
+MAX_TASKS = 500
+# 工作进程的常驻内存上限（MB），超过时换掉进程池
+MAX_RSS_MB = 4096
+# 等待一个任务结果时，在各页面的预算之外多等的秒数
+TASK_GRACE = 60.0
+# 流式模式下一个整文件任务的时间上限（秒），超过后当作工作进程已崩溃
+FILE_TIMEOUT = 3600.0
+
+
+class PageTimeout(Exception):
+    """Raised inside the cleaning of a page that ran over its time budget."""
+
+
+class WorkerLimits:
+    """How long a page may take and how long a worker process lives.
+
+    page_timeout: seconds a page may take before it is cleaned the cheap way
+    (see clear_engine.clean_page); None for no limit.
+    max_tasks: tasks (page batches or files) a worker runs before it is
+    replaced by a new process; None to keep it forever.
+    max_rss_mb: resident memory in MB a worker may report after a task before
+    the pool is replaced; None for no limit.
+    file_timeout: seconds a whole-file task (streaming mode) may take before
+    it is given up as lost; None to wait forever.
+    """
+
+    def __init__(self, page_timeout=PAGE_TIMEOUT, max_tasks=MAX_TASKS, max_rss_mb=MAX_RSS_MB, file_timeout=FILE_TIMEOUT):
+        self.page_timeout = page_timeout
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.file_timeout = file_timeout
+
+    def task_timeout(self, pages):
+        """Seconds to wait for the result of a task of pages pages, or of a whole file for None, before giving it up as lost; None to wait forever.
+
+        A worker that crashes (e.g. killed for running out of memory) never
+        returns its task, and one that hangs never finishes it; the task is
+        reported as failed once this time has passed and the pool is
+        replaced (see WorkerPool.give_up).
+        """
+        if pages is None:
+            return self.file_timeout
+        if self.page_timeout is None:
+            return None
+        # 每页最多用两次预算（原方式和降级方式），再留一倍余量
+        return self.page_timeout * 4 * max(pages, 1) + TASK_GRACE
+
+
+@contextmanager
+def time_budget(seconds):
+    """Raise PageTimeout in the with block once it has run for seconds.
+
+    The timer is a SIGALRM, so it only runs in the main thread on systems that
+    have it; elsewhere, or with seconds None, the block runs without limit.
+    The exception is raised between two Python bytecodes: a single lxml call
+    (e.g. parsing the page) is not interrupted, the stage after it is.
+    """
+    if seconds is None or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expire(signum, frame):
+        raise PageTimeout(f"over the time budget of {seconds:g} seconds")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def rss_mb():
+    """Return the resident memory of this process in MB, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class WorkerPool:
+    """A process pool whose workers are replaced after limits.max_tasks tasks each, and all at once when one grows past limits.max_rss_mb.
+
+    lxml does not give the memory of freed trees back to the system, so a
+    worker only shrinks by exiting. The tasks report the worker's memory
+    (see rss_mb) and the caller passes it to check_rss. A replaced pool
+    finishes the tasks already queued on it before its workers exit; until
+    then both pools run. A task given up as lost (see give_up) replaces the
+    pool as well, so a hung worker stops taking tasks. Used like multiprocessing.Pool: apply_async, close,
+    join and the with statement, which terminates the workers. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, processes, limits=None, initializer=None):
+        self.processes = processes
+        self.limits = limits or WorkerLimits()
+        self.initializer = initializer
+        self.retired = []
+        self.retired_pids = set()
+        self.recycled = 0
+        self._lock = threading.Lock()
+        self.pool = self._start()
+        # 当前进程池的任务，丢失的任务来自已换掉的进程池时不再更换
+        self._results = weakref.WeakSet()
+
+    def _start(self):
+        return Pool(self.processes, initializer=self.initializer, maxtasksperchild=self.limits.max_tasks)
+
+    def apply_async(self, function, args=()):
+        with self._lock:
+            result = self.pool.apply_async(function, args)
+            self._results.add(result)
+            return result
+
+    def check_rss(self, pid, worker_rss_mb):
+        """Replace the pool if the worker pid of the current pool reported more than max_rss_mb; return whether it did."""
+        if (self.limits.max_rss_mb is None or worker_rss_mb is None or worker_rss_mb <= self.limits.max_rss_mb
+                or pid in self.retired_pids):
+            return False
+        with self._lock:
+            if pid in self.retired_pids:
+                return False
+            logging.info(f"Worker {pid} uses {worker_rss_mb:.0f} MB, more than {self.limits.max_rss_mb} MB: replacing the worker processes")
+            self._recycle()
+        return True
+
+    def give_up(self, result):
+        """Replace the pool after the task of result was given up as lost, unless the pool it ran in was already replaced; return whether it did."""
+        with self._lock:
+            if result not in self._results:
+                return False
+            logging.warning("A task was lost, its worker may have crashed or hung: replacing the worker processes")
+            self._recycle()
+        return True
+
+    def _recycle(self):
+        # 旧进程池里的进程之后报告的内存不再触发更换
+        self.retired_pids.update(process.pid for process in active_children())
+        self.pool.close()
+        self.retired.append(self.pool)
+        self.pool = self._start()
+        self._results = weakref.WeakSet()
+        self.recycled += 1
+
+    def close(self):
+        for pool in self.retired + [self.pool]:
+            pool.close()
+
+    def join(self):
+        for pool in self.retired + [self.pool]:
+            pool.join()
+
+    def terminate(self):
+        for pool in self.retired + [self.pool]:
+            pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.terminate()
+        return False
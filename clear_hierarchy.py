@@ -0,0 +1,100 @@
+import logging
+from clear_dedup import canonical_url
+
+
+def url_ancestors(url):
+    """Yield the canonical url of url, then without its query, then of every parent path up to the host, nearest first."""
+    canonical = canonical_url(url)
+    if not canonical:
+        return
+    yield canonical
+    base = canonical.split('?', 1)[0]
+    if base != canonical:
+        yield base
+    # canonical_url 返回 //host/path 的形式
+    while base.count('/') > 2:
+        base = base.rsplit('/', 1)[0]
+        yield base
+
+
+class PageTree:
+    """The pages of a site arranged breadth-first by p_url, built from their (url, p_url) in one indexed walk.
+
+    levels lists the page positions level by level, in file order within a
+    level; parents maps every position to the position of the page it is
+    compared with, or None. Pages without p_url come first, then the pages
+    whose parent url was reached, as before. The pages this leaves out are
+    then placed explicitly instead of being dropped:
+
+    - a page whose url was already reached through another page is compared
+      with its own parent;
+    - an orphan, whose p_url was not crawled, is compared with its nearest
+      crawled ancestor: the page with the same canonical url as p_url or as
+      one of its parent paths (see url_ancestors), if any;
+    - a page on a p_url cycle is placed like an orphan, cutting the cycle
+      there; its descendants follow in later levels.
+    """
+
+    def __init__(self, links):
+        self.levels = []
+        self.parents = {}
+        self.orphans = []
+        self.cycles = []
+        self._links = links
+        self._latest = {}
+        self._canonical = {}
+        children = {}
+        for position, (url, p_url) in enumerate(links):
+            if p_url:
+                children.setdefault(p_url, []).append(position)
+
+        reached = set()
+        level = [position for position, (url, p_url) in enumerate(links) if not p_url]
+        references = dict.fromkeys(level)
+        while True:
+            while level:
+                self._add_level(level, references)
+                new_urls = {links[position][0] for position in level}
+                reached.update(new_urls)
+                level = sorted({child for url in new_urls for child in children.get(url, ()) if links[child][0] not in reached})
+                references = {child: self._latest.get(links[child][1]) for child in level}
+            remaining = [position for position in range(len(links)) if position not in self.parents]
+            if not remaining:
+                break
+            urls = {url for url, _ in links}
+            for position in remaining:
+                p_url = links[position][1]
+                if p_url in reached:
+                    # 同一个 url 已经从别的页面到达过
+                    level.append(position)
+                    references[position] = self._latest.get(p_url)
+                elif p_url not in urls:
+                    level.append(position)
+                    references[position] = self.nearest_ancestor(p_url)
+                    self.orphans.append(position)
+            if not level:
+                # 剩下的页面都在 p_url 环上或其下游，从文件中最靠前的一个切开
+                position = remaining[0]
+                level.append(position)
+                references[position] = self.nearest_ancestor(links[position][1])
+                self.cycles.append(position)
+                logging.warning(f"Breaking a p_url cycle at {links[position][0]}")
+        if self.orphans:
+            logging.info(f"Compared {len(self.orphans)} pages whose p_url was not crawled with their nearest crawled ancestor")
+
+    def _add_level(self, level, references):
+        self.levels.append(level)
+        for position in level:
+            url = self._links[position][0]
+            self.parents[position] = references[position]
+            self._latest[url] = position
+            if url:
+                self._canonical[canonical_url(url)] = position
+
+    def nearest_ancestor(self, p_url):
+        """Return the position of the placed page closest to p_url in the url hierarchy, or None."""
+        for canonical in url_ancestors(p_url):
+            position = self._canonical.get(canonical)
+            if position is not None:
+                return position
+        return None
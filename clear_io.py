@@ -0,0 +1,242 @@
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # 没有安装 orjson 时使用标准库的 json
+    orjson = None
+
+CHUNK_SIZE = 1 << 20
+INPUT_SUFFIXES = ('_hp.json', '_hp.jsonl')
+
+# 页面的原始内容，紧凑格式不再写入输出，而是记录来源文件和页面位置
+RAW_FIELDS = ('body', 'body_html')
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """Feed a text file to JSONDecoder.raw_decode a chunk at a time."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(CHUNK_SIZE):
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        """Decode the next JSON value, reading more of the file until it is complete."""
+        self.peek()
+        size = CHUNK_SIZE
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            # 数字可能恰好在缓冲区末尾被截断，读到更多内容后再解析一次
+            if end == len(self.buffer) and not self.eof and self._fill(size):
+                continue
+            self.pos = end
+            return value
+
+
+def is_jsonl(path):
+    return path.removesuffix('.gz').endswith('.jsonl')
+
+
+def open_text(path, mode='r'):
+    """Open a text file, through gzip when its name ends with .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def iter_pages(path):
+    """Yield the pages of a site file one at a time without loading the whole file.
+
+    ``.jsonl`` files hold one page per line; other files are the crawler's
+    ``{"code": ..., "msg": ..., "data": [...]}`` documents, whose ``data`` items
+    are decoded one by one. Files ending with ``.gz`` are decompressed on the
+    fly.
+    """
+    with open_text(path) as f:
+        if is_jsonl(path):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        reader = _Reader(f)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == 'data':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.peek() != ',':
+                            break
+                        reader.pos += 1
+                    reader.expect(']')
+            else:
+                reader.value()
+            if reader.peek() != ',':
+                break
+            reader.pos += 1
+        reader.expect('}')
+
+
+class OutputFormat:
+    """How cleaned pages are written.
+
+    compact: leave out the raw body and body_html, which the page references
+    by ``source`` (the source file name and the page's index in it) instead,
+    and write without indentation.
+    gzip: compress the output file, whose name gets a ``.gz`` suffix.
+    fast_json: encode compact output with orjson when it is installed.
+    """
+
+    def __init__(self, name, compact=False, gzip=False, fast_json=True):
+        self.name = name
+        self.compact = compact
+        self.gzip = gzip
+        self.fast_json = fast_json
+
+    def config(self):
+        """Everything that affects the written files, for the manifest."""
+        return {'compact': self.compact, 'gzip': self.gzip}
+
+    def file_name(self, src_file):
+        return os.path.basename(src_file) + ('.gz' if self.gzip else '')
+
+    def page(self, page, src_file, index):
+        """Return the page as written, given its source file and its index in it."""
+        if not self.compact:
+            return page
+        page = {key: value for key, value in page.items() if key not in RAW_FIELDS}
+        page['source'] = {'file': os.path.basename(src_file), 'index': index}
+        return page
+
+    def dumps(self, page):
+        """Encode a page on one line, as UTF-8 bytes."""
+        if self.compact and self.fast_json and orjson is not None:
+            try:
+                return orjson.dumps(page)
+            except TypeError:
+                # orjson 不接受孤立的代理字符等内容，这些页面交给标准库
+                pass
+        separators = (',', ':') if self.compact else None
+        return json.dumps(page, ensure_ascii=False, separators=separators).encode('utf-8')
+
+
+FULL = OutputFormat('full')
+COMPACT = OutputFormat('compact', compact=True)
+COMPACT_GZIP = OutputFormat('compact_gzip', compact=True, gzip=True)
+
+OUTPUT_FORMATS = {output_format.name: output_format for output_format in (FULL, COMPACT, COMPACT_GZIP)}
+
+
+def resolve_output_format(output_format):
+    """Turn an OutputFormat, its name or None (FULL) into an OutputFormat."""
+    if output_format is None:
+        return FULL
+    if isinstance(output_format, OutputFormat):
+        return output_format
+    return OUTPUT_FORMATS[output_format]
+
+
+class PageWriter:
+    """Write cleaned pages as soon as they are ready.
+
+    The FULL output is byte-identical to ``json.dump({"data": pages}, f,
+    ensure_ascii=False, indent=4)``, or one compact page per line for JSON
+    Lines; compact formats write ``{"data":[...]}`` without whitespace. Pages
+    go to a temporary file that replaces ``path`` only when the writer is
+    closed without an error.
+    """
+
+    def __init__(self, path, jsonl=None, output_format=FULL):
+        self.path = path
+        self.jsonl = is_jsonl(path) if jsonl is None else jsonl
+        self.output_format = output_format
+        self.count = 0
+        self._tmp_path = path + '.tmp'
+        self._raw = None
+        self._f = None
+
+    def __enter__(self):
+        self._raw = self._f = open(self._tmp_path, 'wb')
+        if self.output_format.gzip:
+            # 压缩级别6和 gzip 命令行默认一致，比默认的9快得多；头部写最终文件名、不写时间，内容不变时输出逐字节相同
+            self._f = gzip.GzipFile(filename=os.path.basename(self.path), mode='wb', fileobj=self._raw, compresslevel=6, mtime=0)
+        return self
+
+    def _close(self):
+        # GzipFile 不关闭传入的文件
+        self._f.close()
+        self._raw.close()
+
+    def write(self, page):
+        if self.jsonl:
+            self._f.write(self.output_format.dumps(page) + b'\n')
+        elif self.output_format.compact:
+            self._f.write((b'{"data":[' if self.count == 0 else b',') + self.output_format.dumps(page))
+        else:
+            # json.dumps 会转义字符串里的换行，所以可以按行缩进
+            text = json.dumps(page, ensure_ascii=False, indent=4).replace('\n', '\n        ')
+            self._f.write((('{\n    "data": [\n        ' if self.count == 0 else ',\n        ') + text).encode('utf-8'))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._close()
+            os.remove(self._tmp_path)
+            return False
+        if self.output_format.compact and not self.jsonl:
+            self._f.write(b'{"data":[]}' if self.count == 0 else b']}')
+        elif not self.jsonl:
+            self._f.write(b'{\n    "data": []\n}' if self.count == 0 else b'\n    ]\n}')
+        self._close()
+        os.replace(self._tmp_path, self.path)
+        return False
+
+
+def write_pages(path, pages, output_format=FULL):
+    """Write pages to path atomically, in the same layout as PageWriter."""
+    with PageWriter(path, output_format=output_format) as writer:
+        for page in pages:
+            writer.write(page)
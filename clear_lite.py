@@ -0,0 +1,260 @@
+import re
+import time
+from lxml import etree, html
+from lxml.html import defs
+from clear_common import normalize_text, raw_block_text
+
+# 与 lxml.html.fromstring 判断完整文档的方式相同，完整文档交给树引擎
+FULL_HTML = re.compile(r'^\s*<(?:html|!doctype)', re.I)
+# 已完成的兄弟元素累计超过这么多字符就先序列化并从树中删除，内存只和这个值以及页面深度有关
+FLUSH_CHARS = 1 << 16
+# 至少这么长的无参考页面才用流式引擎：它比树引擎慢约三到五成，但峰值内存只有几分之一
+STREAM_MIN_CHARS = 1 << 22
+# 已序列化的部分在树中用私用区字符包围的编号代替，最后再换回来
+MARK, END = '\ue000', '\ue001'
+MARKERS = re.compile(f'{MARK}(\\d+){END}')
+# 页面本身含有标记字符（包括字符实体）时不做分段序列化
+ESCAPED_MARK = re.compile(r'&#(?:x0*e000|0*57344)', re.I)
+
+
+def split_markers(text):
+    """Split serialized text into its strings and the numbers of the chunks that go between them."""
+    parts = MARKERS.split(text)
+    for position in range(1, len(parts), 2):
+        parts[position] = int(parts[position])
+    return parts
+
+
+class CleaningTarget:
+    """An lxml parser target that removes footers and empty elements while the page is parsed.
+
+    The elements are built with a TreeBuilder, except those matched by a
+    footer rule: their events are dropped, so neither they nor anything
+    inside them is ever created. An element is checked for emptiness when it
+    ends, after its own children, and detached right away. Comments are
+    dropped, and with them the text that follows, as remove_empty_elements
+    does. Once the finished children of an open element hold more than
+    flush_chars characters they are serialized and replaced by a marker in
+    its text, so the tree never holds much more than the open elements.
+
+    What lxml.html.fromstring would return as soup is decided at the end,
+    from the same raw counts fromstring uses. unsupported is set when the page
+    cannot be cleaned here exactly as the tree engine does, e.g. it has a
+    <head> or a rule matches <body>. With block_text the text is that of
+    clear_common.normalize_text.
+    """
+
+    def __init__(self, rules, flush_chars=FLUSH_CHARS, block_text=False):
+        self.rules = rules
+        self.limit = len(rules.rules) - 1
+        self.flush_chars = flush_chars
+        self.block_text = block_text
+        # 普通的 etree 元素，按 HTML 的规则校验标签名：lxml.html 的元素类查找在 Python 里，每个元素都要调用
+        self.builder = etree.TreeBuilder(parser=etree.HTMLParser())
+        self.hits = []
+        self.unsupported = None
+        self.depth = 0
+        # 被规则删除的子树内的层数，以及是否丢弃接下来的文字（被删节点的 tail）
+        self.skip = 0
+        self.drop_text = False
+        # 打开的元素：[元素, 开始时的字符数, 已完成未序列化的子元素的字符数]
+        self.open = []
+        self.size = 0
+        self.chunks = []
+        # 建出的元素数减去删掉的空元素数，即清洗后 soup 的元素数
+        self.kept = 0
+        self.first_kept = 0
+        # fromstring 选择 soup 用到的原始计数：body 的子节点、text 和最后一个子节点的 tail
+        self.body = None
+        self.body_children = 0
+        self.body_text = []
+        self.last_tail = []
+        self.first_child = None
+        self.first_removed = False
+        self.first_nodes = 0
+        self.first_children = 0
+        self.nodes = 0
+        self.block = False
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        self.size += 1
+        depth = self.depth
+        if depth >= 3:
+            self.nodes += 1
+            if depth == 3:
+                self.body_children += 1
+                self.last_tail = []
+            if self.body_children == 1:
+                self.first_nodes += 1
+                self.first_children += depth == 4
+            if not self.block and tag in defs.block_tags:
+                self.block = True
+        elif tag != ('html', 'body')[depth - 1]:
+            self.unsupported = f'<{tag}> outside <body>'
+        if self.skip:
+            self.skip += 1
+            return
+        rule_no = self.rules.match(tag, attrib, self.limit)
+        if rule_no is not None:
+            self.hits.append(rule_no)
+            if depth < 3:
+                self.unsupported = f'a footer rule matches <{tag}>'
+            elif depth == 3 and self.body_children == 1:
+                self.first_removed = True
+            self.skip = 1
+            return
+        self.drop_text = False
+        element = self.builder.start(tag, attrib)
+        if depth >= 3:
+            self.kept += 1
+            if self.body_children == 1:
+                self.first_kept += 1
+                if depth == 3:
+                    self.first_child = element
+        elif depth == 2:
+            self.body = element
+        if self.open:
+            parent = self.open[-1]
+            # 新元素开始时，之前的兄弟元素连同 tail 都已完整
+            if parent[2] >= self.flush_chars and self._can_flush(depth - 1):
+                self._flush(parent[0], parent[0][:-1])
+                parent[2] = 0
+        self.open.append([element, self.size, 0])
+
+    def end(self, tag):
+        depth = self.depth
+        self.depth -= 1
+        if self.skip:
+            self.skip -= 1
+            self.drop_text = not self.skip
+            return
+        element = self.builder.end(tag)
+        self.drop_text = False
+        _, start_size, pending = self.open.pop()
+        if pending >= self.flush_chars and self._can_flush(depth):
+            self._flush(element, element[:])
+        if depth >= 3 and not (len(element) or element.attrib or (element.text and element.text.strip())):
+            # 空元素连同之后的 tail 一起删掉：TreeBuilder 会把 tail 写到已经脱离的元素上
+            element.getparent().remove(element)
+            self.kept -= 1
+            # body 唯一的子元素即使是空的也仍然是 soup
+            if depth >= 4 and self.body_children == 1:
+                self.first_kept -= 1
+        elif self.open:
+            self.open[-1][2] += self.size - start_size
+
+    def data(self, data):
+        self.size += len(data)
+        if self.depth == 2:
+            (self.last_tail if self.body_children else self.body_text).append(data)
+        if not (self.skip or self.drop_text):
+            self.builder.data(data)
+
+    def comment(self, text):
+        self._other()
+
+    def pi(self, target, data=None):
+        self._other()
+        self.unsupported = 'a processing instruction'
+
+    def _other(self):
+        # 注释和处理指令不会被规则匹配，但算在 fromstring 的原始计数里
+        depth = self.depth + 1
+        if depth == 3:
+            self.body_children += 1
+            self.last_tail = []
+        elif depth == 4 and self.body_children == 1:
+            self.first_children += 1
+        if not self.skip:
+            self.drop_text = True
+
+    def close(self):
+        # 只有空白的页面没有任何元素
+        return self.builder.close() if self.body is not None else None
+
+    def _can_flush(self, depth):
+        # body 只有一个子元素时 soup 可能是这个子元素，body 这一层不能动
+        return depth >= 3 or (depth == 2 and self.body_children > 1)
+
+    def _flush(self, parent, elements):
+        """Serialize finished children of parent, with their tails, and leave a marker in parent's text instead."""
+        if not elements:
+            return
+        html_parts = []
+        text_parts = []
+        for element in elements:
+            html_parts.append(html.tostring(element, encoding='unicode', method='html'))
+            text_parts.append(self._text(element))
+            text_parts.append(element.tail or '')
+            parent.remove(element)
+        parent.text = f'{parent.text or ""}{MARK}{len(self.chunks)}{END}'
+        self.chunks.append((split_markers(''.join(html_parts)), split_markers(''.join(text_parts))))
+
+    def _text(self, element):
+        # 块元素的标记在整段文本拼好后才换成换行
+        if self.block_text:
+            return raw_block_text(element)
+        return etree.tostring(element, encoding='unicode', method='text', with_tail=False)
+
+    def _resolve(self, text, which):
+        if not self.chunks:
+            return text
+        out = []
+        stack = [iter(split_markers(text))]
+        while stack:
+            for part in stack[-1]:
+                if isinstance(part, int):
+                    stack.append(iter(self.chunks[part][which]))
+                    break
+                out.append(part)
+            else:
+                stack.pop()
+        return ''.join(out)
+
+    def soup(self):
+        """Return the cleaned element lxml.html.fromstring would have returned, its element count before and after cleaning and whether it had children."""
+        if self.body is None:
+            self.unsupported = 'no <body>'
+            return None, 0, 0, False
+        if self.body_children == 1 and not ''.join(self.body_text).strip() and not ''.join(self.last_tail).strip():
+            if self.first_child is None or self.first_removed:
+                self.unsupported = 'the page root is not an element or is matched by a footer rule'
+                return None, 0, 0, False
+            return self.first_child, self.first_nodes, self.first_kept, self.first_children > 0
+        self.body.tag = 'div' if self.block else 'span'
+        return self.body, self.nodes + 1, self.kept + 1, self.body_children > 0
+
+    def serialize(self, soup):
+        """Return the HTML and text of the cleaned soup, as clear_engine.serialize would."""
+        body_html = self._resolve(html.tostring(soup, encoding='unicode', method='html'), 0)
+        body_text = self._resolve(self._text(soup), 1)
+        return body_html, normalize_text(body_text) if self.block_text else body_text.strip()
+
+
+def clean_streaming(content, rules, flush_chars=FLUSH_CHARS, block_text=False):
+    """Clean a page that has no reference page in one parse and return (body_html, text, has_children, nodes, nodes_left), or None.
+
+    The result is what parsing content with lxml.html.fromstring, removing
+    the elements matched by rules (a BoilerplateRules), then
+    remove_empty_elements and clear_engine.serialize(soup, block_text) would
+    give; nodes and nodes_left are the element counts of soup before and after. None means the page must go
+    through the tree engine, and rules then count nothing.
+    """
+    if not content or FULL_HTML.match(content):
+        return None
+    start_time = time.perf_counter()
+    if flush_chars is None or MARK in content or ESCAPED_MARK.search(content):
+        flush_chars = float('inf')
+    target = CleaningTarget(rules, flush_chars, block_text)
+    try:
+        etree.fromstring(content, etree.HTMLParser(target=target))
+    except (ValueError, etree.LxmlError):
+        # 例如 TreeBuilder 不接受的标签名，交给树引擎，它会给出同样的结果或同样的错误
+        return None
+    soup, nodes, nodes_left, has_children = target.soup()
+    if target.unsupported is not None:
+        return None
+    rules.record(target.hits, time.perf_counter() - start_time)
+    body_html, body_text = target.serialize(soup)
+    return body_html, body_text, has_children, nodes, nodes_left
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+from clear_io import CHUNK_SIZE, iter_pages
+from clear_rules import site_rules_path
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def content_hash(content):
+    """Return the hex digest of a str or bytes value."""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def file_hash(path):
+    """Return the hex digest of a file's content, read a chunk at a time."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def page_hash(company, reference_hash=None):
+    """Hash a page before it is cleaned, together with the hash of the reference page it is compared with."""
+    return content_hash(json.dumps(company, ensure_ascii=False, sort_keys=True) + '\0' + (reference_hash or ''))
+
+
+class Manifest:
+    """What a previous run wrote to an output folder, so later runs can skip or reuse the work.
+
+    Each entry records the content hash of an input file, the hash of the
+    cleaning config it was processed with, the hash of every page in output
+    order and the size and mtime of the output file. An entry is appended as
+    soon as its output is written, so an interrupted run resumes after the
+    last finished file; the last entry of a file wins and a torn last line is
+    ignored.
+    """
+
+    def __init__(self, dst_folder, config):
+        self.path = os.path.join(dst_folder, MANIFEST_NAME)
+        self.config = content_hash(json.dumps(config, ensure_ascii=False, sort_keys=True))
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"Ignoring a broken line in {self.path}")
+                        continue
+                    self.entries[entry['file']] = entry
+
+    def file_config(self, src_file):
+        """Hash of the cleaning config of src_file, including its site-specific rule file."""
+        rules_path = site_rules_path(src_file)
+        site_rules = file_hash(rules_path) if os.path.exists(rules_path) else ''
+        return content_hash(self.config + site_rules)
+
+    @staticmethod
+    def output_state(dst_file):
+        if not os.path.exists(dst_file):
+            return None
+        stat = os.stat(dst_file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def entry(self, src_file, dst_file):
+        """Return the entry of src_file if dst_file is still the output it records, under the current config."""
+        entry = self.entries.get(os.path.basename(src_file))
+        if entry is None or entry['output'] != self.output_state(dst_file) or entry['config'] != self.file_config(src_file):
+            return None
+        return entry
+
+    def previous_pages(self, entry, dst_file):
+        """Map the hash of every page recorded in entry to its cleaned page in dst_file."""
+        if entry is None or not entry['pages']:
+            return {}
+        try:
+            pages = list(iter_pages(dst_file))
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Cannot reuse pages of {dst_file}: {e}")
+            return {}
+        if len(pages) != len(entry['pages']):
+            return {}
+        return dict(zip(entry['pages'], pages))
+
+    def record(self, src_file, dst_file, source_hash, page_hashes=()):
+        """Append the entry of a file whose output was just written."""
+        entry = {
+            'file': os.path.basename(src_file),
+            'hash': source_hash,
+            'config': self.file_config(src_file),
+            'pages': list(page_hashes),
+            'output': self.output_state(dst_file),
+        }
+        self.entries[entry['file']] = entry
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def compact(self):
+        """Rewrite the manifest with one entry per file."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
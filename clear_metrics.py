@@ -0,0 +1,223 @@
+import bisect
+import json
+import logging
+import math
+import os
+import time
+
+# 清洗流程的各个阶段，按处理顺序排列
+STAGES = ('load', 'stream', 'parse', 'copy', 'index', 'template', 'features', 'density', 'footer', 'global', 'ending', 'similar', 'prune', 'serialize', 'write')
+
+# 直方图的上界（秒），与 Prometheus 默认的桶相近，但细到 0.1 毫秒
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts of observed durations per bucket, plus their sum, merged by addition."""
+
+    def __init__(self):
+        # 最后一个桶是 +Inf
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+class Metrics:
+    """Per-stage latency histograms and per-site counters of one process.
+
+    Every worker fills its own Metrics without any locking; they are sent
+    back with the results and merged at the end of the run. ``sites`` maps a
+    site file name to its pages, bytes in and out, element counts and removed
+    elements and the seconds spent cleaning its pages. The counters are summed
+    over the outputs, so a page written to two variants counts twice whether
+    the variants were cleaned together or one after the other. ``counters``
+    holds run-wide counts such as the deduplication hits, and ``errors`` the
+    pages and files that failed or fell back to a cheaper cleaning (see
+    add_error), for the error report. ``profiles`` maps a profiled site file
+    name to its clear_profile.Profile; it stays empty unless profiling is on.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.sites = {}
+        self.counters = {}
+        self.errors = []
+        self.profiles = {}
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+    def call(self, stage, function, *args):
+        """Call function(*args) and record its duration under stage."""
+        start_time = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def increment(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_error(self, kind, site, error, url=None, fallback=None):
+        """Record a failure: kind counts it (e.g. 'page_timeouts'), fallback tells what was written instead, if anything."""
+        self.increment(kind)
+        self.errors.append({'kind': kind, 'site': site, 'url': url, 'error': f"{type(error).__name__}: {error}", 'fallback': fallback})
+
+    def add_page(self, site, outputs, bytes_in, bytes_out, nodes, nodes_removed, seconds):
+        counters = self.sites.get(site)
+        if counters is None:
+            counters = self.sites[site] = {'pages': 0, 'bytes_in': 0, 'bytes_out': 0, 'nodes': 0, 'nodes_removed': 0, 'seconds': 0.0}
+        counters['pages'] += outputs
+        counters['bytes_in'] += bytes_in
+        counters['bytes_out'] += bytes_out
+        counters['nodes'] += nodes
+        counters['nodes_removed'] += nodes_removed
+        counters['seconds'] += seconds
+
+    def merge(self, other):
+        """Add the histograms and counters of another Metrics to this one and return self."""
+        if other is None:
+            return self
+        for stage, histogram in other.stages.items():
+            self.stages.setdefault(stage, Histogram()).merge(histogram)
+        for site, counters in other.sites.items():
+            merged = self.sites.setdefault(site, dict.fromkeys(counters, 0))
+            for name, value in counters.items():
+                merged[name] += value
+        for counter, value in other.counters.items():
+            self.increment(counter, value)
+        self.errors.extend(other.errors)
+        for site, profile in other.profiles.items():
+            if site in self.profiles:
+                self.profiles[site].merge(profile)
+            else:
+                self.profiles[site] = profile
+        return self
+
+    def stage_seconds(self):
+        return {stage: self.stages[stage].sum for stage in self.ordered_stages()}
+
+    def ordered_stages(self):
+        return sorted(self.stages, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES))
+
+    def report(self):
+        """Return the merged metrics as a JSON-serializable dict."""
+        stages = {}
+        for stage in self.ordered_stages():
+            histogram = self.stages[stage]
+            stages[stage] = {
+                'count': histogram.count,
+                'seconds': histogram.sum,
+                'p50': histogram.quantile(0.5),
+                'p99': histogram.quantile(0.99),
+                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram.counts)),
+            }
+        sites = {}
+        # 最耗时的站点排在前面
+        for site, counters in sorted(self.sites.items(), key=lambda item: -item[1]['seconds']):
+            sites[site] = dict(counters, removed_fraction=counters['nodes_removed'] / counters['nodes'] if counters['nodes'] else 0.0)
+        return {'stages': stages, 'sites': sites, 'counters': dict(sorted(self.counters.items()))}
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=4)
+
+    def write_errors(self, path):
+        """Write the recorded failures as a JSON list, worst first: failed files, then failed pages, then fallbacks."""
+        order = {'failed_files': 0, 'page_errors': 1}
+        errors = sorted(self.errors, key=lambda error: (order.get(error['kind'], 2), error['site'] or '', error['url'] or ''))
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(errors, f, ensure_ascii=False, indent=4)
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = ['# HELP clear_stage_seconds Time spent in each cleaning stage.', '# TYPE clear_stage_seconds histogram']
+        for stage in self.ordered_stages():
+            lines.extend(histogram_lines('clear_stage_seconds', self.stages[stage], f'stage="{stage}"'))
+        site_metrics = [
+            ('pages', 'Pages cleaned per site, summed over the outputs.'),
+            ('bytes_in', 'Bytes of body_html cleaned per site, summed over the outputs.'),
+            ('bytes_out', 'Bytes of body_html_new written per site, summed over the outputs.'),
+            ('nodes', 'Elements of the pages before cleaning per site, summed over the outputs.'),
+            ('nodes_removed', 'Elements removed per site, summed over the outputs.'),
+            ('seconds', 'Seconds spent cleaning the pages of each site.'),
+        ]
+        for name, help_text in site_metrics:
+            lines.append(f'# HELP clear_site_{name} {help_text}')
+            lines.append(f'# TYPE clear_site_{name} gauge')
+            for site, counters in sorted(self.sites.items()):
+                lines.append(f'clear_site_{name}{{site="{escape_label(site)}"}} {counters[name]!r}')
+        for counter, value in sorted(self.counters.items()):
+            lines.append(f'# HELP clear_{counter}_total {counter.replace("_", " ").capitalize()} in the run.')
+            lines.append(f'# TYPE clear_{counter}_total counter')
+            lines.append(f'clear_{counter}_total {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus text exposition format, e.g. for the node exporter textfile collector."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        # textfile collector 可能随时读取，写完再替换
+        os.replace(tmp_path, path)
+
+
+def histogram_lines(name, histogram, labels=''):
+    """Return the Prometheus sample lines of a Histogram: its cumulative buckets, sum and count."""
+    lines = []
+    cumulative = 0
+    for bound, count in zip([repr(bound) for bound in BUCKETS] + ['+Inf'], histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {histogram.sum!r}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+    return lines
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def count_nodes(soup):
+    """Count the elements of soup, soup included."""
+    return sum(1 for _ in soup.iter('*')) if soup is not None else 0
+
+
+def log_metrics(metrics, top_sites=5):
+    """Log the time of each stage and the most expensive sites."""
+    report = metrics.report()
+    for stage, stats in report['stages'].items():
+        logging.info(f"Stage {stage}: {stats['count']} calls, {stats['seconds']:.2f} seconds, "
+                     f"p50 <= {stats['p50'] * 1000:g} ms, p99 <= {stats['p99'] * 1000:g} ms")
+    for counter, value in report['counters'].items():
+        logging.info(f"Counter {counter}: {value}")
+    for site, counters in list(report['sites'].items())[:top_sites]:
+        logging.info(f"Site {site}: {counters['pages']} pages, {counters['bytes_in'] / 1024:.0f} KiB in, "
+                     f"{counters['bytes_out'] / 1024:.0f} KiB out, {counters['removed_fraction']:.0%} of elements removed "
+                     f"in {counters['seconds']:.2f} seconds")
@@ -0,0 +1,203 @@
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from clear_common import text_fingerprint
+from clear_metrics import Metrics
+
+# 采样间隔（秒）
+SAMPLE_INTERVAL = 0.002
+# 分配汇总里列出的代码行数
+TOP_ALLOCATIONS = 25
+# 按比例抽样文件时的精度
+RATE_SCALE = 1_000_000
+
+
+def source_name(filename):
+    """Name a source file by its base name, with its package for an __init__.py."""
+    name = os.path.basename(filename)
+    if name == '__init__.py':
+        return os.path.join(os.path.basename(os.path.dirname(filename)), name)
+    return name
+
+
+class Profiling:
+    """Which site files to profile and how, for process_json_files_in_folder.
+
+    A file is profiled when its name is in files, or when it falls in the
+    sample rate (0 to 1) of files, chosen by a hash of the name so the same
+    files are picked in every run and every process. The stages of a
+    profiled file are sampled every interval seconds and its allocations
+    traced; the profiles are written to folder at the end of the run (see
+    Profile.write). Files that are not profiled run exactly as without it.
+    """
+
+    def __init__(self, folder, files=(), rate=0.0, interval=SAMPLE_INTERVAL, top=TOP_ALLOCATIONS):
+        self.folder = folder
+        self.files = {os.path.basename(src_file) for src_file in files}
+        self.rate = rate
+        self.interval = interval
+        self.top = top
+
+    def target(self, src_file):
+        """Return the ProfileTarget of src_file, or None if it is not profiled."""
+        site = os.path.basename(src_file)
+        if site in self.files or (self.rate and text_fingerprint(site) % RATE_SCALE < self.rate * RATE_SCALE):
+            return ProfileTarget(site, self.interval, self.top)
+        return None
+
+
+class ProfileTarget:
+    """The site to profile and the sampling settings, sent to the workers that clean its pages."""
+
+    def __init__(self, site, interval=SAMPLE_INTERVAL, top=TOP_ALLOCATIONS):
+        self.site = site
+        self.interval = interval
+        self.top = top
+
+
+def profiled_metrics(target):
+    """Return a Metrics for work on a file: a ProfiledMetrics for a ProfileTarget, a plain Metrics for None."""
+    return Metrics() if target is None else ProfiledMetrics(target)
+
+
+class Profile:
+    """What profiling a site gave: sampled stacks, the allocation peak of each stage and the top allocations.
+
+    ``stacks`` maps a collapsed stack, stage first and innermost frame last,
+    to its number of samples. ``stage_peaks`` holds the most memory allocated
+    by Python code during one call of each stage, and ``allocations`` maps a
+    source line to the [bytes, blocks] it still held when profiling ended.
+    Memory allocated by lxml itself is not traced.
+    """
+
+    def __init__(self, top=TOP_ALLOCATIONS):
+        self.top = top
+        self.stacks = Counter()
+        self.stage_peaks = {}
+        self.allocations = {}
+
+    def merge(self, other):
+        self.stacks.update(other.stacks)
+        for stage, peak in other.stage_peaks.items():
+            self.stage_peaks[stage] = max(peak, self.stage_peaks.get(stage, 0))
+        for line, (size, count) in other.allocations.items():
+            merged = self.allocations.setdefault(line, [0, 0])
+            merged[0] += size
+            merged[1] += count
+        return self
+
+    def write(self, folder, site):
+        """Write <site>.folded, the collapsed stacks for flamegraph.pl or speedscope, and <site>.alloc.txt, the allocation summary."""
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f'{site}.folded'), 'w', encoding='utf-8') as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write(f'{stack} {samples}\n')
+        lines = [f'Peak Python allocations per stage call for {site}:']
+        for stage, peak in sorted(self.stage_peaks.items(), key=lambda item: -item[1]):
+            lines.append(f'  {stage}: {peak / 1024:.1f} KiB')
+        lines.append(f'Top {self.top} lines by memory held at the end:')
+        for line, (size, count) in sorted(self.allocations.items(), key=lambda item: -item[1][0])[:self.top]:
+            lines.append(f'  {line}: {size / 1024:.1f} KiB in {count} blocks')
+        with open(os.path.join(folder, f'{site}.alloc.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+class Sampler(threading.Thread):
+    """Record the stack of a thread every interval seconds while it runs a stage.
+
+    The stack is cut below Metrics.call, which timed the stage, and prefixed
+    with the stage name, so the stages are the roots of the flame graph.
+    """
+
+    def __init__(self, thread_id, interval, stacks):
+        super().__init__(name='clear-profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = stacks
+        # (阶段名, ProfiledMetrics.call 的帧)，不在阶段里时为 None
+        self.current = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            current = self.current
+            if current is None:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            # 停在 Metrics.call 的帧，它的上一帧是 ProfiledMetrics.call
+            while frame is not None and frame.f_back is not current[1]:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({source_name(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if frame is None:
+                # 采样时阶段已经结束
+                continue
+            names.append(current[0])
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class ProfiledMetrics(Metrics):
+    """A Metrics that also samples the stack and traces the allocations of every stage it times.
+
+    Only the outermost stage of nested calls is profiled; the inner one shows
+    up in its stacks. finish() stops the sampler and takes the allocation
+    snapshot; the Profile is then in profiles[site] and is merged and sent
+    back with the rest of the metrics.
+    """
+
+    def __init__(self, target):
+        super().__init__()
+        self.profile = self.profiles[target.site] = Profile(target.top)
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        self.sampler = Sampler(threading.get_ident(), target.interval, self.profile.stacks)
+        self.sampler.start()
+
+    def call(self, stage, function, *args):
+        if self.sampler is None or self.sampler.current is not None:
+            return super().call(stage, function, *args)
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.sampler.current = (stage, sys._getframe())
+        try:
+            return super().call(stage, function, *args)
+        finally:
+            self.sampler.current = None
+            peak = tracemalloc.get_traced_memory()[1] - base
+            self.profile.stage_peaks[stage] = max(peak, self.profile.stage_peaks.get(stage, 0))
+
+    def finish(self):
+        """Stop profiling and record the lines holding the most memory; return self."""
+        if self.sampler is None:
+            return self
+        self.sampler.stop()
+        self.sampler = None
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        for statistic in snapshot.statistics('lineno')[:self.profile.top]:
+            frame = statistic.traceback[0]
+            self.profile.allocations[f'{source_name(frame.filename)}:{frame.lineno}'] = [statistic.size, statistic.count]
+        if self.tracing:
+            tracemalloc.stop()
+        return self
+
+    def __getstate__(self):
+        # 采样线程不随指标发回主进程
+        state = dict(self.__dict__)
+        state['sampler'] = None
+        return state
+
+
+def write_profiles(profiles, folder):
+    """Write the Profile of every profiled site to folder."""
+    for site, profile in profiles.items():
+        profile.write(folder, site)
+        logging.info(f"Wrote the profile of {site} to {os.path.join(folder, site)}.folded and .alloc.txt")
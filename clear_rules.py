@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import time
+from lxml import etree
+
+
+def describe_rule(rule):
+    """Return a short readable form of a rule, e.g. div[class*='footer']."""
+    return (rule.get('tag') or '*') + ''.join(f"[{name}*='{value}']" for name, value in rule.items() if name != 'tag')
+
+
+def load_rules(path):
+    """Load a JSON list of rules such as [{"tag": "div", "class": "footer"}, {"id": "bottom"}]."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return check_rules(json.load(f), f"Rule file {path}")
+
+
+def check_rules(rules, source):
+    """Return rules if they are a list of non-empty objects with string values, else raise ValueError naming source."""
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) and rule for rule in rules):
+        raise ValueError(f"{source} must contain a list of non-empty objects")
+    for rule in rules:
+        if not all(isinstance(value, str) for value in rule.values()):
+            raise ValueError(f"Rule {rule} in {source} must only have string values")
+    return rules
+
+
+def site_rules_path(src_file):
+    """Return the path of the site-specific rule file for src_file (xxx_hp.json -> xxx_rules.json)."""
+    for suffix in ('_hp.json', '_hp.jsonl'):
+        if src_file.endswith(suffix):
+            return src_file[:-len(suffix)] + '_rules.json'
+    return os.path.splitext(src_file)[0] + '_rules.json'
+
+
+class BoilerplateRules:
+    """A rule set compiled once and matched against a page in a single traversal.
+
+    Each rule is a dict with an optional ``tag`` (any tag when missing) and any
+    number of attributes whose value must contain the given substring, so
+    ``{"tag": "div", "class": "footer"}`` is ``//div[contains(@class, 'footer')]``.
+    Per-rule hit counts and the time spent matching are kept for ``stats()``.
+    """
+
+    def __init__(self, rules, timed=False):
+        self.rules = [dict(rule) for rule in rules]
+        self.timed = timed
+        self._any = []
+        by_tag = {}
+        for rule_no, rule in enumerate(self.rules):
+            conditions = tuple((name, value) for name, value in rule.items() if name != 'tag')
+            tag = rule.get('tag')
+            if tag and tag != '*':
+                by_tag.setdefault(tag, []).append((rule_no, conditions))
+            else:
+                self._any.append((rule_no, conditions))
+        # 每个标签预先合并好通配规则，匹配时只需一次字典查找
+        self._by_tag = {tag: sorted(checks + self._any) for tag, checks in by_tag.items()}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._hits = [0] * len(self.rules)
+        self._rule_seconds = [0.0] * len(self.rules)
+        self._calls = 0
+        self._seconds = 0.0
+
+    def extend(self, rules):
+        """Return a new rule set with rules appended to these ones."""
+        return BoilerplateRules(self.rules + list(rules), timed=self.timed)
+
+    def match(self, tag, attributes, limit):
+        """Return the number of the first rule up to limit that matches tag and attributes (anything with .get()), or None."""
+        for rule_no, conditions in self._by_tag.get(tag, self._any):
+            if rule_no > limit:
+                break
+            start_time = time.perf_counter() if self.timed else 0.0
+            matched = True
+            for name, value in conditions:
+                attribute = attributes.get(name)
+                if attribute is None or value not in attribute:
+                    matched = False
+                    break
+            if self.timed:
+                self._rule_seconds[rule_no] += time.perf_counter() - start_time
+            if matched:
+                return rule_no
+        return None
+
+    def remove(self, soup, on_remove=None):
+        """Remove every element of soup's document matched by a rule and return the removed elements.
+
+        Matches inside an already matched element are not visited, except when
+        the match contains soup itself: soup is what gets serialized, and the
+        rules that come before the match still apply inside it, exactly as with
+        the per-rule XPath passes this replaces. on_remove(element, None) is
+        called just before each element is removed.
+        """
+        if soup is None:
+            return []
+        start_time = time.perf_counter()
+        containers = {soup, *soup.iterancestors()}
+        limit = len(self.rules) - 1
+        matches = []
+        walker = etree.iterwalk(soup.getroottree().getroot(), events=('start',))
+        for _, element in walker:
+            rule_no = self.match(element.tag, element, limit)
+            if rule_no is None:
+                continue
+            self._hits[rule_no] += 1
+            if element.getparent() is None:
+                continue
+            matches.append(element)
+            if element in containers:
+                limit = rule_no
+            else:
+                walker.skip_subtree()
+        for element in matches:
+            if on_remove is not None:
+                on_remove(element, None)
+            element.getparent().remove(element)
+        self._calls += 1
+        self._seconds += time.perf_counter() - start_time
+        return matches
+
+    def record(self, hits, seconds):
+        """Count one page matched outside remove(), given the numbers of the rules that matched and the time it took."""
+        for rule_no in hits:
+            self._hits[rule_no] += 1
+        self._calls += 1
+        self._seconds += seconds
+
+    def stats(self):
+        """Return hit counts and time spent so far, keyed by rule description."""
+        rules = {}
+        for rule_no, rule in enumerate(self.rules):
+            rule_stats = rules.setdefault(describe_rule(rule), {'hits': 0, 'seconds': 0.0})
+            rule_stats['hits'] += self._hits[rule_no]
+            rule_stats['seconds'] += self._rule_seconds[rule_no]
+        return {'calls': self._calls, 'seconds': self._seconds, 'rules': rules}
+
+
+def merge_rule_stats(all_stats):
+    """Merge stats() results from several files or workers."""
+    merged = {'calls': 0, 'seconds': 0.0, 'rules': {}}
+    for stats in all_stats:
+        if not stats:
+            continue
+        merged['calls'] += stats['calls']
+        merged['seconds'] += stats['seconds']
+        for description, rule_stats in stats['rules'].items():
+            merged_rule = merged['rules'].setdefault(description, {'hits': 0, 'seconds': 0.0})
+            merged_rule['hits'] += rule_stats['hits']
+            merged_rule['seconds'] += rule_stats['seconds']
+    return merged
+
+
+_site_rules = {}
+
+
+def rules_for_file(rules, src_file):
+    """Return rules extended with the site-specific rule file of src_file, if there is one.
+
+    Compiled rule sets are cached per worker and rebuilt when the rule file changes.
+    """
+    path = site_rules_path(src_file)
+    if not os.path.exists(path):
+        return rules
+    key = (id(rules), path, os.path.getmtime(path))
+    site_rules = _site_rules.get(key)
+    if site_rules is None:
+        site_rules = _site_rules[key] = rules.extend(load_rules(path))
+    return site_rules
+
+
+def log_rule_stats(stats):
+    """Log merged rule stats, busiest rules first."""
+    logging.info(f"Footer rules: {stats['calls']} pages matched in {stats['seconds']:.2f} seconds")
+    for description, rule_stats in sorted(stats['rules'].items(), key=lambda item: -item[1]['hits']):
+        # 只有 timed=True 时才有单条规则的耗时
+        seconds = f", {rule_stats['seconds']:.3f} seconds" if rule_stats['seconds'] else ''
+        logging.info(f"  {description}: {rule_stats['hits']} hits{seconds}")
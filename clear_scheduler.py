@@ -0,0 +1,448 @@
+import logging
+import os
+import time
+from collections import deque
+from multiprocessing import TimeoutError as ResultTimeout, cpu_count
+from clear_dedup import duplicate_page
+from clear_density import learn_filter, page_blocks
+from clear_guard import WorkerLimits, WorkerPool, rss_mb
+from clear_io import FULL, write_pages
+from clear_manifest import file_hash, page_hash
+from clear_metrics import Metrics
+from clear_profile import profiled_metrics
+from clear_rules import merge_rule_stats
+from clear_template import count_blocks, merge_counts
+
+# 每批页面数：足够小以便大站点分摊到所有进程，又不至于让进程间传输占主导
+BATCH_PAGES = 16
+
+
+class SitePlan:
+    """The pages of one site file with the reference data they are cleaned against, for one or more outputs.
+
+    ``pages`` is a list of ``(company, keys)`` where ``keys`` maps each output
+    that writes the page to the key of its reference page (or None);
+    ``orders`` maps each output to the page positions in its output order.
+    ``references`` maps each key to the ReferenceIndex of a reference page (or
+    None) and ``reference_hashes`` to the content hash of that page. ``rules``
+    maps each output to its footer rules and ``options`` holds extra keyword
+    arguments for clean_page. ``cache`` is the DocumentCache the references
+    were built with, for cleaning in-process. ``duplicates`` maps the position
+    of a page that cleans exactly like an earlier page to the position of that
+    page (see clear_dedup.find_duplicates). ``groups`` maps a position to
+    its parent in the page hierarchy (see clear_hierarchy.PageTree); pages
+    with the same parent are batched together, so a batch carries fewer
+    reference pages.
+    """
+
+    def __init__(self, src_file, pages, orders, references, rules, options=None, cache=None, reference_hashes=None, duplicates=None,
+                 groups=None):
+        self.src_file = src_file
+        self.pages = pages
+        self.orders = orders
+        self.references = references
+        self.rules = rules
+        self.options = options or {}
+        self.cache = cache
+        self.reference_hashes = reference_hashes or {}
+        self.duplicates = duplicates or {}
+        self.groups = groups or {}
+
+    def page_hashes(self, output, template=None, block_filter=None):
+        """Hash the pages of output in its order with their reference page, template and block filter; call before the pages are cleaned."""
+        template_hash = template.hash if template is not None else ''
+        hashes = []
+        for position in self.orders[output]:
+            company, keys = self.pages[position]
+            filter_hash = block_filter.page_hash(company.get('body_html')) if block_filter is not None else ''
+            hashes.append(page_hash(company, (self.reference_hashes.get(keys[output]) or '') + template_hash + filter_hash))
+        return hashes
+
+    def release(self, key):
+        """Drop the reference page of key, and its parsed tree, once no remaining page is compared with it."""
+        self.references.pop(key, None)
+        if self.cache is not None:
+            self.cache.release(self.pages[key][0].get('body_html'))
+
+    def distinct_rules(self):
+        """Return each footer rule set once, however many outputs share it."""
+        return list({id(rules): rules for rules in self.rules.values()}.values())
+
+    def batches(self, batch_pages=BATCH_PAGES, units=None):
+        """Yield (pages, references) for consecutive slices of at most batch_pages units.
+
+        A unit is (position, outputs) and becomes (company, keys of outputs);
+        all pages with all their outputs when units is None. Each batch only
+        carries the references its own pages need.
+        """
+        if units is None:
+            units = [(position, keys) for position, (_, keys) in enumerate(self.pages)]
+        for start in range(0, len(units), batch_pages):
+            batch = []
+            for position, outputs in units[start:start + batch_pages]:
+                company, keys = self.pages[position]
+                batch.append((company, {output: keys[output] for output in outputs}))
+            needed = {key for _, keys in batch for key in keys.values() if key is not None}
+            yield batch, {key: self.references[key] for key in needed}
+
+
+def clean_batch(clean_page, pages, references, rules, options, template=None, profile=None):
+    """Clean a batch of pages in a worker and return (pid, busy seconds, cleaned pages, rule stats, Metrics, worker RSS in MB).
+
+    Each cleaned page is what clean_page(company, keys, references, rules,
+    template, metrics=metrics, **options) returns: a dict of the page cleaned
+    for each output. With profile (a clear_profile.ProfileTarget) the stages
+    are profiled and the Profile comes back in the Metrics.
+    """
+    start_time = time.perf_counter()
+    metrics = profiled_metrics(profile)
+    try:
+        distinct_rules = list({id(output_rules): output_rules for output_rules in rules.values()}.values())
+        for output_rules in distinct_rules:
+            output_rules.reset_stats()
+        cleaned = [clean_page(company, keys, references, rules, template, metrics=metrics, **options) for company, keys in pages]
+        rule_stats = merge_rule_stats(output_rules.stats() for output_rules in distinct_rules)
+    finally:
+        # 批次失败时也要停止采样和内存跟踪，否则这个工作进程之后的批次都要承担开销
+        if profile is not None:
+            metrics.finish()
+    return os.getpid(), time.perf_counter() - start_time, cleaned, rule_stats, metrics, rss_mb()
+
+
+def count_batch(companies):
+    """Collect the template blocks of a batch of pages in a worker and return (pid, busy seconds, count_blocks result, worker RSS in MB)."""
+    start_time = time.perf_counter()
+    counts = count_blocks([company.get('body_html') for company in companies])
+    return os.getpid(), time.perf_counter() - start_time, counts, rss_mb()
+
+
+def feature_batch(companies):
+    """Extract the block features of a batch of pages in a worker and return (pid, busy seconds, PageBlocks of each page, worker RSS in MB)."""
+    start_time = time.perf_counter()
+    tables = [page_blocks(company.get('body_html')) for company in companies]
+    return os.getpid(), time.perf_counter() - start_time, tables, rss_mb()
+
+
+def timed_call(function, *args):
+    """Call function in a worker and return (pid, busy seconds, its result, worker RSS in MB)."""
+    start_time = time.perf_counter()
+    result = function(*args)
+    return os.getpid(), time.perf_counter() - start_time, result, rss_mb()
+
+
+def task_result(pool, result, pages=None):
+    """Wait for the result of a task of pages pages (None for a whole file) in a WorkerPool and return it, replacing the workers if the one that ran it grew too large.
+
+    Raises TimeoutError when the task is given up as lost (see
+    WorkerLimits.task_timeout), after replacing the workers, and whatever
+    the task raised.
+    """
+    timeout = pool.limits.task_timeout(pages)
+    try:
+        returned = result.get(timeout)
+    except ResultTimeout:
+        pool.give_up(result)
+        raise TimeoutError(f"no result after {timeout:g} seconds, the worker may have crashed or hung") from None
+    pool.check_rss(returned[0], returned[-1])
+    return returned
+
+
+def failed_file(stats, src_file, error):
+    """Record a file that could not be cleaned; it is not written, so the next incremental run tries it again."""
+    logging.error(f"Failed to process {src_file}: {type(error).__name__}: {error}")
+    stats.metrics.add_error('failed_files', os.path.basename(src_file), error)
+
+
+def changed_outputs(src_file, outputs, manifests, output_format=FULL):
+    """Return (content hash of src_file, {output: manifest entry} of the outputs that must be written again).
+
+    Without manifests every output is written and the hash is None. The entry
+    is None for an output with nothing to reuse.
+    """
+    if manifests is None:
+        return None, dict.fromkeys(outputs)
+    source_hash = file_hash(src_file)
+    changed = {}
+    for output, dst_folder in outputs.items():
+        entry = manifests[output].entry(src_file, os.path.join(dst_folder, output_format.file_name(src_file)))
+        if entry is None or entry['hash'] != source_hash:
+            changed[output] = entry
+    return source_hash, changed
+
+
+class ScheduleStats:
+    """Per-worker busy time collected from the batches, to show how evenly the work was spread.
+
+    ``metrics`` merges the Metrics sent back by the workers and
+    ``site_blocks`` the block fingerprints of each site they processed.
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.files = 0
+        self.skipped_files = 0
+        self.reused_pages = 0
+        self.rule_stats = []
+        self.metrics = Metrics()
+        self.site_blocks = {}
+
+    def add(self, pid, seconds, pages, rule_stats, metrics=None, site_blocks=None):
+        worker = self.workers.setdefault(pid, {'batches': 0, 'pages': 0, 'seconds': 0.0})
+        worker['batches'] += 1
+        worker['pages'] += pages
+        worker['seconds'] += seconds
+        if rule_stats is not None:
+            self.rule_stats.append(rule_stats)
+        self.metrics.merge(metrics)
+        for site, fingerprints in (site_blocks or {}).items():
+            self.site_blocks.setdefault(site, set()).update(fingerprints)
+
+    @property
+    def busy_time(self):
+        return sum(worker['seconds'] for worker in self.workers.values())
+
+    def log(self, wall_time, processes):
+        """Log each worker's share of the wall-clock time, busiest first."""
+        for pid, worker in sorted(self.workers.items(), key=lambda item: -item[1]['seconds']):
+            utilization = worker['seconds'] / wall_time if wall_time else 0
+            logging.info(f"Worker {pid}: {worker['batches']} batches, {worker['pages']} pages, "
+                         f"busy {worker['seconds']:.2f} seconds ({utilization:.0%})")
+        if wall_time and processes:
+            logging.info(f"Worker utilization: {self.busy_time / (wall_time * processes):.0%} of {processes} processes")
+        if self.skipped_files or self.reused_pages:
+            logging.info(f"Reused previous output: {self.skipped_files} unchanged files, {self.reused_pages} unchanged pages")
+
+
+def run_sites(files, plan_file, clean_page, outputs, processes=None, batch_pages=BATCH_PAGES, manifests=None,
+              template_threshold=None, output_format=FULL, limits=None, density_threshold=None, profiling=None):
+    """Clean site files with page batches spread over a process pool.
+
+    outputs maps each output to its dst_folder. Files are planned in this
+    process, largest first, so the batches of the biggest sites are queued
+    early. plan_file(src_file, outputs) returns a SitePlan for the listed
+    outputs or None to skip the file; clean_page cleans one page for all its
+    outputs in a worker (see clean_batch). The cleaned pages of a site are put
+    back in each output's order before the site is written. A page that is a
+    duplicate of another page cleaned in the same run is not sent to the
+    workers; it gets the other page's result. Only a bounded number of pages
+    is in flight at a time.
+
+    With manifests ({output: Manifest}), files whose content and config are
+    unchanged since the last run are skipped for every output they are
+    unchanged in, and in changed files only the changed pages are cleaned
+    again. With template_threshold the blocks of each site are first counted
+    in batches too, and the merged SiteTemplate is sent with every cleaning
+    batch of the site. With density_threshold the block features of each
+    site are extracted in batches as well, scored in this process in one
+    batch (see clear_density.learn_filter), and every cleaning batch gets the
+    blocks to remove from its pages. Pages are written in output_format (a
+    clear_io.OutputFormat). With profiling (a clear_profile.Profiling) the
+    cleaning batches of the files it picks are profiled, and the profiles are
+    merged in the metrics. Returns the ScheduleStats of the run.
+
+    The workers live within limits (a clear_guard.WorkerLimits, its defaults
+    when None). A file whose planning or any batch fails, or whose batch is
+    lost with a crashed worker, is recorded in the metrics and not written;
+    the other files go on.
+    """
+    if processes is None:
+        processes = cpu_count()
+    limits = limits or WorkerLimits()
+    max_pending_pages = processes * batch_pages * 4
+    stats = ScheduleStats()
+    learning = deque()
+    pending = deque()
+    pending_pages = 0
+
+    def submit(plan, source_hash, previous, template, block_filter):
+        slots = {}
+        page_hashes = {}
+        needed = {}
+        for output, order in plan.orders.items():
+            slots[output] = [None] * len(order)
+            if manifests is not None:
+                page_hashes[output] = plan.page_hashes(output, template, block_filter)
+                for index, page_key in enumerate(page_hashes[output]):
+                    slots[output][index] = previous[output].get(page_key)
+                stats.reused_pages += sum(page is not None for page in slots[output])
+            for index, position in enumerate(order):
+                if slots[output][index] is None:
+                    needed.setdefault(position, {})[output] = index
+        # 重复页面不再清洗，等原页面清洗完后复制结果
+        copies = []
+        for position, original in plan.duplicates.items():
+            if position in needed and needed.get(original, {}).keys() >= needed[position].keys():
+                copies.append((plan.pages[position][0], needed[original], needed.pop(position)))
+        stats.metrics.increment('duplicate_pages', sum(len(indexes) for _, _, indexes in copies))
+        # 一个页面的所有输出在同一个批次里，只解析一次；同一父页面的页面相邻
+        units = sorted(needed.items(), key=lambda unit: (plan.groups.get(unit[0], -1), unit[0]))
+        profile = profiling.target(plan.src_file) if profiling is not None else None
+        results = []
+        for pages, references in plan.batches(batch_pages, units):
+            options = plan.options
+            if block_filter is not None:
+                options = dict(options, block_filter=block_filter.subset(company.get('body_html') for company, _ in pages))
+            results.append((pool.apply_async(clean_batch, (clean_page, pages, references, plan.rules, options, template, profile)),
+                            len(pages)))
+        # 提交后不再持有页面，清洗后的页面由各批次的结果带回
+        pending.append((plan.src_file, source_hash, page_hashes, plan.orders, slots, units, copies, results, len(plan.pages)))
+
+    def submit_learned(block):
+        """Queue the cleaning of sites whose blocks have all been counted and scored, oldest first."""
+        nonlocal pending_pages
+        while learning and (block or all(result.ready() for _, result, _ in learning[0][-1])):
+            plan, source_hash, previous, results = learning.popleft()
+            block = False
+            learned = {'template': [], 'features': []}
+            try:
+                for stage, result, pages in results:
+                    pid, seconds, batch_result, _ = task_result(pool, result, pages)
+                    stats.add(pid, seconds, 0, None)
+                    stats.metrics.observe(stage, seconds)
+                    learned[stage].append(batch_result)
+            except Exception as e:
+                failed_file(stats, plan.src_file, e)
+                pending_pages -= len(plan.pages)
+                continue
+            template = merge_counts(learned['template'], template_threshold, plan.src_file) if template_threshold else None
+            block_filter = None
+            if density_threshold:
+                tables = [table for batch_tables in learned['features'] for table in batch_tables]
+                block_filter = stats.metrics.call('features', learn_filter, tables, density_threshold, plan.src_file)
+            submit(plan, source_hash, previous, template, block_filter)
+
+    def finish_oldest():
+        if not pending:
+            submit_learned(block=True)
+            if not pending:
+                return 0
+        src_file, source_hash, page_hashes, orders, slots, units, copies, results, pages = pending.popleft()
+        done = 0
+        try:
+            for result, batch_pages in results:
+                pid, seconds, cleaned, rule_stats, metrics, _ = task_result(pool, result, batch_pages)
+                stats.add(pid, seconds, len(cleaned), rule_stats, metrics)
+                for page in cleaned:
+                    for output, index in units[done][1].items():
+                        slots[output][index] = page[output]
+                    done += 1
+        except Exception as e:
+            failed_file(stats, src_file, e)
+            return pages
+        for company, original, indexes in copies:
+            for output, index in indexes.items():
+                slots[output][index] = duplicate_page(slots[output][original[output]], company)
+        for output, cleaned in slots.items():
+            dst_file = os.path.join(outputs[output], output_format.file_name(src_file))
+            cleaned = [output_format.page(page, src_file, position) for page, position in zip(cleaned, orders[output])]
+            stats.metrics.call('write', write_pages, dst_file, cleaned, output_format)
+            logging.info(f"Processed and saved: {dst_file}")
+            if manifests is not None:
+                manifests[output].record(src_file, dst_file, source_hash, page_hashes[output])
+        stats.files += 1
+        return pages
+
+    with WorkerPool(processes, limits) as pool:
+        for src_file in sorted(files, key=os.path.getsize, reverse=True):
+            source_hash, changed = changed_outputs(src_file, outputs, manifests, output_format)
+            if not changed:
+                logging.info(f"Skipping unchanged file: {src_file}")
+                stats.skipped_files += 1
+                continue
+            previous = {}
+            if manifests is not None:
+                previous = {output: manifests[output].previous_pages(entry, os.path.join(outputs[output], output_format.file_name(src_file)))
+                            for output, entry in changed.items()}
+            try:
+                plan = plan_file(src_file, list(changed))
+            except Exception as e:
+                failed_file(stats, src_file, e)
+                continue
+            if plan is None:
+                continue
+            pending_pages += len(plan.pages)
+            if template_threshold or density_threshold:
+                results = []
+                for pages, _ in plan.batches(batch_pages):
+                    companies = [company for company, _ in pages]
+                    if template_threshold:
+                        results.append(('template', pool.apply_async(count_batch, (companies,)), len(pages)))
+                    if density_threshold:
+                        results.append(('features', pool.apply_async(feature_batch, (companies,)), len(pages)))
+                learning.append((plan, source_hash, previous, results))
+            else:
+                submit(plan, source_hash, previous, None, None)
+            submit_learned(block=False)
+            while pending_pages > max_pending_pages and len(learning) + len(pending) > 1:
+                pending_pages -= finish_oldest()
+        while learning or pending:
+            pending_pages -= finish_oldest()
+    if pool.recycled:
+        stats.metrics.increment('worker_pool_recycles', pool.recycled)
+    if manifests is not None:
+        for manifest in manifests.values():
+            manifest.compact()
+    return stats
+
+
+def run_files(files, process_file, args, outputs, processes=None, manifests=None, output_format=FULL, limits=None):
+    """Run process_file(src_file, outputs, *args) on whole files in a process pool.
+
+    This is the mode for streaming, where each file is read and written a page
+    at a time by one process. process_file returns its rule stats, Metrics
+    and {site: block fingerprints}, or None for a file that was not saved. With manifests ({output: Manifest}), a file is
+    only passed the outputs it changed in, and each output is recorded once
+    written. output_format tells the manifests where process_file writes
+    each output. Returns the ScheduleStats of the run.
+
+    The workers live within limits (a clear_guard.WorkerLimits, its defaults
+    when None); files are handed out a few at a time, so files submitted
+    after the workers are replaced run in the new ones. A file that raises,
+    or that is still running after limits.file_timeout seconds, is recorded
+    in the metrics and the other files go on.
+    """
+    limits = limits or WorkerLimits()
+    stats = ScheduleStats()
+    changed_files = []
+    for src_file in files:
+        source_hash, changed = changed_outputs(src_file, outputs, manifests, output_format)
+        if not changed:
+            logging.info(f"Skipping unchanged file: {src_file}")
+            stats.skipped_files += 1
+            continue
+        changed_files.append((src_file, source_hash, {output: outputs[output] for output in changed}))
+    if not changed_files:
+        return stats
+    if processes is None:
+        processes = min(len(changed_files), cpu_count())
+
+    with WorkerPool(processes, limits) as pool:
+        queued = deque(changed_files)
+        running = deque()
+        while queued or running:
+            # 每个进程最多排两个文件，进程池更换后新提交的文件在新进程里运行
+            while queued and len(running) < processes * 2:
+                src_file, source_hash, file_outputs = queued.popleft()
+                running.append((src_file, source_hash, file_outputs,
+                                pool.apply_async(timed_call, (process_file, src_file, file_outputs) + tuple(args))))
+            src_file, source_hash, file_outputs, result = running.popleft()
+            try:
+                pid, seconds, returned, _ = task_result(pool, result)
+            except Exception as e:
+                failed_file(stats, src_file, e)
+                continue
+            if returned is None:
+                stats.add(pid, seconds, 0, None)
+                continue
+            rule_stats, metrics, site_blocks = returned
+            stats.add(pid, seconds, 0, rule_stats, metrics, site_blocks)
+            stats.files += 1
+            if manifests is not None:
+                for output, dst_folder in file_outputs.items():
+                    manifests[output].record(src_file, os.path.join(dst_folder, output_format.file_name(src_file)), source_hash)
+    if pool.recycled:
+        stats.metrics.increment('worker_pool_recycles', pool.recycled)
+    if manifests is not None:
+        for manifest in manifests.values():
+            manifest.compact()
+    return stats
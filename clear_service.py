@@ -0,0 +1,395 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import cpu_count
+from lxml import html
+from clear_common import REFERENCE_BUDGET
+from clear_dedup import duplicate_page
+from clear_density import check_numpy, learn_filter
+from clear_guard import WorkerLimits, WorkerPool
+from clear_engine import VARIANTS, clean_page, plan_pages
+from clear_io import resolve_output_format
+from clear_metrics import Histogram, Metrics, histogram_lines
+from clear_rules import check_rules, merge_rule_stats, rules_for_file
+from clear_scheduler import BATCH_PAGES, clean_batch, count_batch, feature_batch, task_result
+from clear_store import resolve_store, site_fingerprints
+from clear_template import merge_counts
+
+# 默认的 HTTP 地址，只监听本机
+HOST = '127.0.0.1'
+PORT = 8765
+# 请求体的上限，防止一个请求占满内存
+MAX_REQUEST_BYTES = 256 << 20
+
+
+def warm_worker():
+    """Pool initializer: set up lxml's HTML parser in the worker before the first job arrives."""
+    html.fromstring('<div><p>warm</p></div>')
+
+
+class CleaningService:
+    """Clean sites sent as jobs, in a pool of worker processes started once and kept for every job.
+
+    A job is a dict like a site file, {"site": "xxx_hp.json", "data": [pages]},
+    optionally with "outputs" (variant names, all the service's outputs by
+    default), "rules" (extra footer rules for this site) and "id" (returned
+    as is). The site is planned in this process, as run_sites does, and its
+    pages are cleaned in batches in the pool; the result holds the cleaned
+    pages of every output in its order, as the files written by a batch run
+    would.
+
+    The compiled footer rules, the site-specific rule files under
+    rules_folder (<site>_rules.json next to where the site file would be)
+    and the fingerprints of the boilerplate store stay in memory between
+    jobs; the store is updated with the blocks of each site after its job.
+    status() and prometheus() report the jobs and batches in flight and the
+    latency of the jobs. Jobs may come from several threads at once.
+
+    The workers live within limits (a clear_guard.WorkerLimits, its defaults
+    when None): pages over their time budget are cleaned the cheap way, and
+    workers are replaced after a number of batches or when their memory grows
+    too large, so the service does not keep lxml's memory forever. A job
+    whose batch is lost with a crashed worker, or that fails in any other
+    way, is answered with an error; the other jobs go on.
+    With density_threshold, the blocks of all pages of a job are scored
+    together and the low-content ones removed (see clear_density).
+    """
+
+    def __init__(self, outputs=tuple(VARIANTS), processes=None, batch_pages=BATCH_PAGES, template_threshold=None,
+                 fuzzy_threshold=None, boilerplate_store=None, reference_budget=REFERENCE_BUDGET, output_format=None, rules_folder=None,
+                 limits=None, density_threshold=None):
+        self.variants = {name: VARIANTS[name] for name in outputs}
+        self.processes = processes or cpu_count()
+        self.batch_pages = batch_pages
+        self.template_threshold = template_threshold
+        self.fuzzy_threshold = fuzzy_threshold
+        self.boilerplate_store = resolve_store(boilerplate_store)
+        self.reference_budget = reference_budget
+        self.output_format = resolve_output_format(output_format)
+        self.rules_folder = rules_folder
+        self.limits = limits or WorkerLimits()
+        if density_threshold:
+            check_numpy()
+        self.density_threshold = density_threshold
+        self.pool = WorkerPool(self.processes, self.limits, initializer=warm_worker)
+        self.started = time.time()
+        self.metrics = Metrics()
+        self.rule_stats = None
+        self.latency = Histogram()
+        self.jobs = 0
+        self.errors = 0
+        self.pages = 0
+        self.jobs_in_flight = 0
+        self.batches_in_flight = 0
+        self._lock = threading.Lock()
+        # 计划在本进程里做，各线程依次进行：它和 GIL 抢的是同一个 CPU，加锁不损失吞吐
+        self._plan_lock = threading.Lock()
+        self._job_rules = {}
+        logging.info(f"Cleaning service started with {self.processes} worker processes for {', '.join(self.variants)}")
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def rules(self, site, variants, extra_rules=None):
+        """Return {variant name: footer rules} for a site, compiled once per site rule file and per set of extra rules."""
+        rules = {}
+        for name, variant in variants.items():
+            site_rules = variant.rules
+            if self.rules_folder:
+                site_rules = rules_for_file(site_rules, os.path.join(self.rules_folder, site))
+            if extra_rules:
+                key = (id(site_rules), json.dumps(extra_rules, sort_keys=True))
+                if key not in self._job_rules:
+                    self._job_rules[key] = site_rules.extend(check_rules(extra_rules, f"Rules of job for {site}"))
+                site_rules = self._job_rules[key]
+            rules[name] = site_rules
+        return rules
+
+    def clean(self, job):
+        """Clean one job and return {"id", "site", "pages", "seconds", "outputs": {name: pages}}, or {"id", "site", "error"}.
+
+        Pages that failed or were cleaned the cheap way are listed under
+        "page_errors" (see Metrics.add_error).
+        """
+        start_time = time.perf_counter()
+        with self._lock:
+            self.jobs_in_flight += 1
+        result = {'id': job.get('id'), 'site': job.get('site')} if isinstance(job, dict) else {'id': None, 'site': None}
+        try:
+            result.update(self._clean(job))
+        except Exception as e:
+            # 任何失败都只作为这个作业的错误返回，不影响服务和其他作业
+            result['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            with self._lock:
+                self.jobs_in_flight -= 1
+                depth = self.jobs_in_flight
+        seconds = time.perf_counter() - start_time
+        result['seconds'] = seconds
+        with self._lock:
+            self.jobs += 1
+            self.errors += 'error' in result
+            self.latency.observe(seconds)
+        if 'error' in result:
+            logging.warning(f"Job for {result['site']} failed after {seconds * 1000:.1f} ms: {result['error']}")
+        else:
+            logging.info(f"Cleaned {result['site']}: {result['pages']} pages in {seconds * 1000:.1f} ms, {depth} jobs in flight")
+        return result
+
+    def _clean(self, job):
+        if not isinstance(job, dict):
+            raise TypeError("a job must be a JSON object")
+        site = job.get('site')
+        companies = job.get('data')
+        if not site or not isinstance(site, str) or os.path.basename(site) != site:
+            raise ValueError("a job needs a site file name, e.g. xxx_hp.json")
+        if not isinstance(companies, list) or not all(isinstance(company, dict) for company in companies):
+            raise ValueError("data must be a list of pages")
+        names = job.get('outputs') or list(self.variants)
+        unknown = [name for name in names if name not in self.variants]
+        if unknown:
+            raise ValueError(f"unknown outputs {unknown}, the service writes {list(self.variants)}")
+        if not any(company.get('body_html') for company in companies):
+            # 和批处理一样，没有 body_html 的站点不输出
+            return {'pages': len(companies), 'outputs': {}}
+
+        metrics = Metrics()
+        variants = {name: self.variants[name] for name in names}
+        with self._plan_lock:
+            rules = self.rules(site, variants, job.get('rules'))
+            plan = plan_pages(site, companies, variants, metrics, self.fuzzy_threshold, self.boilerplate_store, self.reference_budget, rules,
+                              self.limits.page_timeout)
+        plan.cache = None
+
+        template = None
+        if self.template_threshold:
+            counts = [result[2] for result in self._map(count_batch, [([company for company, _ in pages],) for pages, _ in plan.batches(self.batch_pages)])]
+            template = merge_counts(counts, self.template_threshold, site)
+        block_filter = None
+        if self.density_threshold:
+            tables = [table for result in self._map(feature_batch, [([company for company, _ in pages],) for pages, _ in plan.batches(self.batch_pages)])
+                      for table in result[2]]
+            block_filter = metrics.call('features', learn_filter, tables, self.density_threshold, site)
+
+        # 重复页面不再清洗，清洗完后复制原页面的结果
+        units = [(position, list(keys)) for position, (_, keys) in enumerate(plan.pages) if keys and position not in plan.duplicates]
+        # 同一父页面的页面放在同一批次，少传参考页面
+        units.sort(key=lambda unit: (plan.groups.get(unit[0], -1), unit[0]))
+        cleaned = {}
+        rule_stats = []
+        batches = list(plan.batches(self.batch_pages, units))
+        calls = []
+        for pages, references in batches:
+            options = plan.options
+            if block_filter is not None:
+                options = dict(options, block_filter=block_filter.subset(company.get('body_html') for company, _ in pages))
+            calls.append((clean_page, pages, references, plan.rules, options, template))
+        results = self._map(clean_batch, calls)
+        done = 0
+        for _, _, pages, batch_rule_stats, batch_metrics, _ in results:
+            metrics.merge(batch_metrics)
+            rule_stats.append(batch_rule_stats)
+            for page in pages:
+                cleaned[units[done][0]] = page
+                done += 1
+        for position, original in plan.duplicates.items():
+            company = plan.pages[position][0]
+            cleaned[position] = {name: duplicate_page(page, company) for name, page in cleaned[original].items()}
+        metrics.increment('duplicate_pages', sum(len(plan.pages[position][1]) for position in plan.duplicates))
+        outputs = {name: [self.output_format.page(cleaned[position][name], site, position) for position in order]
+                   for name, order in plan.orders.items()}
+
+        if self.boilerplate_store is not None:
+            with self._plan_lock:
+                self.boilerplate_store.update({site: site_fingerprints(plan.references.values())})
+                # 服务不复用之前的输出，下一个任务直接用最新的快照
+                self.boilerplate_store.refresh()
+        # 失败和降级的页面随任务结果返回，服务的指标里只留计数
+        errors = metrics.errors
+        metrics.errors = []
+        with self._lock:
+            self.metrics.merge(metrics)
+            self.rule_stats = merge_rule_stats([self.rule_stats] + rule_stats)
+            self.pages += len(companies)
+        result = {'pages': len(companies), 'outputs': outputs}
+        if errors:
+            result['page_errors'] = errors
+        return result
+
+    def _map(self, function, calls):
+        """Run function(*args) for every args in calls in the pool and return the results in order."""
+        with self._lock:
+            self.batches_in_flight += len(calls)
+        results = [self.pool.apply_async(function, args) for args in calls]
+        try:
+            # 每个调用是一个批次，最多 batch_pages 个页面
+            return [task_result(self.pool, result, self.batch_pages) for result in results]
+        finally:
+            with self._lock:
+                self.batches_in_flight -= len(calls)
+
+    def status(self):
+        """Return the state of the service as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                'uptime': time.time() - self.started,
+                'processes': self.processes,
+                'outputs': list(self.variants),
+                'jobs': self.jobs,
+                'errors': self.errors,
+                'pages': self.pages,
+                'jobs_in_flight': self.jobs_in_flight,
+                'batches_in_flight': self.batches_in_flight,
+                'worker_pool_recycles': self.pool.recycled,
+                'latency': {
+                    'mean': self.latency.sum / self.latency.count if self.latency.count else 0.0,
+                    'p50': self.latency.quantile(0.5),
+                    'p99': self.latency.quantile(0.99),
+                },
+                'rules': self.rule_stats,
+                'metrics': self.metrics.report(),
+            }
+
+    def prometheus(self):
+        """Return the metrics of every job so far and the state of the service in the Prometheus text format."""
+        with self._lock:
+            lines = [
+                '# HELP clear_service_job_seconds Time from receiving a job to returning its result.',
+                '# TYPE clear_service_job_seconds histogram',
+                *histogram_lines('clear_service_job_seconds', self.latency),
+                '# HELP clear_service_jobs_in_flight Jobs received and not answered yet.',
+                '# TYPE clear_service_jobs_in_flight gauge',
+                f'clear_service_jobs_in_flight {self.jobs_in_flight}',
+                '# HELP clear_service_batches_in_flight Page batches queued or running in the worker processes.',
+                '# TYPE clear_service_batches_in_flight gauge',
+                f'clear_service_batches_in_flight {self.batches_in_flight}',
+                '# HELP clear_service_errors_total Jobs answered with an error.',
+                '# TYPE clear_service_errors_total counter',
+                f'clear_service_errors_total {self.errors}',
+            ]
+            return '\n'.join(lines) + '\n' + self.metrics.prometheus()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """POST /clean with a job as JSON returns its result; GET /status returns status() and GET /metrics prometheus()."""
+
+    service = None
+
+    def do_POST(self):
+        if self.path != '/clean':
+            self.reply(404, {'error': f"no endpoint {self.path}"})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_BYTES:
+            self.reply(413, {'error': f"request of {length} bytes is larger than {MAX_REQUEST_BYTES}"})
+            return
+        try:
+            job = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.reply(400, {'error': f"invalid JSON: {e}"})
+            return
+        result = self.service.clean(job)
+        self.reply(400 if 'error' in result else 200, result)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply(200, self.service.status())
+        elif self.path == '/metrics':
+            self.send_body(200, self.service.prometheus().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            self.reply(404, {'error': f"no endpoint {self.path}"})
+
+    def reply(self, code, result):
+        self.send_body(code, json.dumps(result, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 每个任务已经由 CleaningService.clean 记录
+        pass
+
+
+def serve_http(service, host=HOST, port=PORT):
+    """Answer jobs over HTTP until interrupted, one thread per connection."""
+    handler = type('Handler', (ServiceHandler,), {'service': service})
+    with ThreadingHTTPServer((host, port), handler) as server:
+        logging.info(f"Listening on http://{host}:{server.server_address[1]}/clean")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Stopping the cleaning service")
+
+
+def serve_pipe(service, lines=None, out=None, jobs_in_flight=None):
+    """Read one job per line (JSON Lines) from lines and write one result per line to out, in the same order.
+
+    Up to jobs_in_flight jobs (by default twice the worker processes) are
+    cleaned at once, so the pool stays busy while results are written.
+    """
+    lines = sys.stdin if lines is None else lines
+    out = sys.stdout if out is None else out
+    jobs_in_flight = jobs_in_flight or service.processes * 2
+    pending = deque()
+
+    def clean_line(line_no, line):
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            return {'id': None, 'site': None, 'error': f"invalid JSON on line {line_no}: {e}"}
+        return service.clean(job)
+
+    def write_oldest():
+        out.write(json.dumps(pending.popleft().result(), ensure_ascii=False) + '\n')
+        out.flush()
+
+    with ThreadPoolExecutor(jobs_in_flight) as executor:
+        for line_no, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            pending.append(executor.submit(clean_line, line_no, line))
+            while len(pending) >= jobs_in_flight or (pending and pending[0].done()):
+                write_oldest()
+        while pending:
+            write_oldest()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    mode = 'http'  # 'http'：在 host:port 上接收任务；'pipe'：从标准输入逐行读取任务，结果逐行写到标准输出（日志写到标准错误）
+    host = HOST  # HTTP 监听的地址，默认只接受本机的请求
+    port = PORT  # HTTP 监听的端口
+    outputs = ['hierarchical', 'simplified', 'with_deleted']  # 服务输出的变体，任务可以只要其中一部分
+    max_processes = None  # 可选：设置为None时，使用全部CPU，否则设置为你想要的工作进程数量
+    template_threshold = None  # 可选：设置为0到1之间的数（如0.5）时，按站点模板去除重复出现的块
+    fuzzy_threshold = None  # 可选：设置为0到1之间的数（如0.8）时，与参考页面近似重复的块也删除
+    boilerplate_store = None  # 可选：跨站点模板库的SQLite文件路径，如'boilerplate.sqlite'，每个任务结束后更新
+    reference_budget = 256 << 20  # 可选：每个站点的参考页面解析树最多占用的内存（字节），None为不限制
+    output_format = 'full'  # 可选：'compact'只返回清洗结果和来源页面位置
+    rules_folder = None  # 可选：站点专属规则文件（xxx_rules.json）所在的文件夹
+    density_threshold = None  # 可选：设置为0到1之间的数（如0.2）时，按块的长度、链接比例等打分，删除得分低的块（需要numpy）
+
+    with CleaningService(outputs, max_processes, BATCH_PAGES, template_threshold, fuzzy_threshold, boilerplate_store, reference_budget,
+                         output_format, rules_folder, density_threshold=density_threshold) as service:
+        if mode == 'pipe':
+            serve_pipe(service)
+        else:
+            serve_http(service, host, port)
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from array import array
+from clear_common import remove_blocks, text_fingerprint, text_spans
+
+# 至少出现在这么多个站点里的块才算通用模板（备案号、建站商署名、通用的CMS页脚）
+MIN_SITES = 3
+# 太短的块（如“首页”“更多”）在正文里也常见，即使出现在很多站点也不删除
+MIN_CHARS = 10
+
+_known = {}
+
+
+def to_signed(fingerprint):
+    """SQLite integers are signed 64-bit."""
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def site_fingerprints(references):
+    """Return the fingerprints of the blocks of a site, taken from the ReferenceIndex of its reference pages (or None)."""
+    fingerprints = set()
+    for reference_index in references:
+        if reference_index is not None:
+            fingerprints.update(reference_index.fingerprints)
+    return fingerprints
+
+
+def resolve_store(store):
+    """Accept a BoilerplateStore, the path of its file, or None."""
+    if store is None or isinstance(store, BoilerplateStore):
+        return store
+    return BoilerplateStore(store)
+
+
+class GlobalBoilerplate:
+    """The blocks known to repeat across at least min_sites different sites, removed with one hash lookup per element.
+
+    Blocks shorter than MIN_CHARS are stored but never removed.
+    """
+
+    def __init__(self, fingerprints):
+        self.fingerprints = frozenset(fingerprints)
+        digest = hashlib.blake2b(digest_size=16)
+        for fingerprint in sorted(self.fingerprints):
+            digest.update(fingerprint.to_bytes(8, 'big'))
+        self.hash = digest.hexdigest()
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def remove_matches(self, soup, on_remove=None):
+        """Remove the elements of soup whose stripped text is known global boilerplate and return them."""
+        text, elements, spans = text_spans(soup)
+
+        def is_match(position):
+            start, end, _ = spans[position]
+            element_text = text[start:end].strip()
+            return len(element_text) >= MIN_CHARS and text_fingerprint(element_text) in self.fingerprints
+
+        return remove_blocks(soup, elements, spans, is_match, on_remove)
+
+
+class BoilerplateStore:
+    """A SQLite file with the block fingerprints of every site processed so far and the number of sites each appears on.
+
+    Only the path and min_sites are kept, so the store can be sent to worker
+    processes; each process reads the known boilerplate once (see known()).
+    The fingerprints each site contributed are kept too, so a site processed
+    again replaces its old blocks instead of counting them twice. A site's
+    blocks come from its reference pages, which depend on the variants
+    written, so use one store per set of outputs.
+
+    The blocks removed from pages are a snapshot of the blocks found on at
+    least min_sites sites, taken by refresh(); update() only changes the
+    counts. The snapshot stays the same between refreshes however many sites
+    are added, so the outputs cleaned with it can be reused by incremental
+    runs (its hash is part of the manifest config).
+    """
+
+    def __init__(self, path, min_sites=MIN_SITES):
+        self.path = path
+        self.min_sites = min_sites
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE IF NOT EXISTS blocks (fingerprint INTEGER PRIMARY KEY, sites INTEGER NOT NULL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS sites (site TEXT PRIMARY KEY, fingerprints BLOB NOT NULL)')
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'known'").fetchone() is None:
+            # 旧的存储没有快照表，按当前计数建一份，结果与之前一致
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS known (fingerprint INTEGER PRIMARY KEY)')
+                connection.execute('INSERT INTO known SELECT fingerprint FROM blocks WHERE sites >= ?', (self.min_sites,))
+        return connection
+
+    def known(self):
+        """Return the GlobalBoilerplate of the store's snapshot, read once per process and again only when the file changed."""
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        key = (os.path.abspath(self.path), self.min_sites, mtime)
+        boilerplate = _known.get(key)
+        if boilerplate is None:
+            fingerprints = []
+            if mtime is not None:
+                connection = self.connect()
+                try:
+                    rows = connection.execute('SELECT fingerprint FROM known')
+                    fingerprints = [fingerprint % (1 << 64) for fingerprint, in rows]
+                finally:
+                    connection.close()
+            boilerplate = _known[key] = GlobalBoilerplate(fingerprints)
+        return boilerplate
+
+    def refresh(self):
+        """Take a new snapshot of the blocks found on at least min_sites sites; return whether it changed.
+
+        Every output cleaned with the previous snapshot is cleaned again by
+        the next incremental run when it changed.
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                before = {fingerprint for fingerprint, in connection.execute('SELECT fingerprint FROM known')}
+                after = {fingerprint for fingerprint, in connection.execute('SELECT fingerprint FROM blocks WHERE sites >= ?', (self.min_sites,))}
+                if before != after:
+                    connection.execute('DELETE FROM known')
+                    connection.executemany('INSERT INTO known (fingerprint) VALUES (?)', ((fingerprint,) for fingerprint in after))
+        finally:
+            connection.close()
+        logging.info(f"Boilerplate store {self.path}: snapshot of {len(after)} blocks" + (' (changed)' if before != after else ' (unchanged)'))
+        return before != after
+
+    def update(self, site_blocks):
+        """Record {site: fingerprints} in one transaction, replacing what those sites contributed before; the snapshot is not changed (see refresh)."""
+        if not site_blocks:
+            return
+        connection = self.connect()
+        try:
+            with connection:
+                added = []
+                removed = []
+                for site, fingerprints in site_blocks.items():
+                    fingerprints = {to_signed(fingerprint) for fingerprint in fingerprints}
+                    row = connection.execute('SELECT fingerprints FROM sites WHERE site = ?', (site,)).fetchone()
+                    previous = set(array('q', row[0])) if row else set()
+                    added.extend((fingerprint,) for fingerprint in fingerprints - previous)
+                    removed.extend((fingerprint,) for fingerprint in previous - fingerprints)
+                    connection.execute('INSERT OR REPLACE INTO sites (site, fingerprints) VALUES (?, ?)',
+                                       (site, array('q', sorted(fingerprints)).tobytes()))
+                connection.executemany('INSERT INTO blocks (fingerprint, sites) VALUES (?, 1) '
+                                       'ON CONFLICT (fingerprint) DO UPDATE SET sites = sites + 1', added)
+                connection.executemany('UPDATE blocks SET sites = sites - 1 WHERE fingerprint = ?', removed)
+                connection.execute('DELETE FROM blocks WHERE sites <= 0')
+                sites, = connection.execute('SELECT COUNT(*) FROM sites').fetchone()
+                known, = connection.execute('SELECT COUNT(*) FROM blocks WHERE sites >= ?', (self.min_sites,)).fetchone()
+        finally:
+            connection.close()
+        logging.info(f"Updated boilerplate store {self.path} with {len(site_blocks)} sites: "
+                     f"{known} blocks appear on at least {self.min_sites} of {sites} sites")
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import math
+from collections import Counter
+from lxml import html
+from clear_common import remove_blocks, text_fingerprint, text_spans
+
+# 默认阈值：至少出现在一半页面里的块算作站点模板
+TEMPLATE_THRESHOLD = 0.5
+
+
+def block_table(soup):
+    """Return the text of soup's document, its elements, their text spans, parent positions, DOM path steps and block keys.
+
+    The step of an element is its tag and classes, its parent position is -1
+    for the root. The key is the fingerprint of the element's DOM path (the
+    steps from the root) and its whitespace-normalized text, or None for an
+    element without text.
+    """
+    text, elements, spans = text_spans(soup)
+    positions = {}
+    parents = []
+    steps = []
+    paths = []
+    keys = []
+    for position, element in enumerate(elements):
+        positions[element] = position
+        step = element.tag
+        if element.get('class'):
+            step += '.' + '.'.join(element.get('class').split())
+        parent = element.getparent()
+        parents.append(-1 if parent is None else positions[parent])
+        steps.append(step)
+        paths.append(step if parent is None else paths[parents[-1]] + '/' + step)
+        start, end, _ = spans[position]
+        block_text = ' '.join(text[start:end].split())
+        keys.append(text_fingerprint(paths[-1] + '\0' + block_text) if block_text else None)
+    return text, elements, spans, parents, steps, keys
+
+
+def block_keys(soup):
+    """Return the elements of soup's document, their text spans and the block key of each element (see block_table)."""
+    _, elements, spans, _, _, keys = block_table(soup)
+    return elements, spans, keys
+
+
+def count_blocks(contents):
+    """Return {fingerprint of the page's HTML: frozenset of its block keys} for the pages of contents, for merge_counts.
+
+    Pages with the same content (e.g. one page crawled under several url
+    variants) are one entry, so their blocks are not counted as repeating
+    across the site.
+    """
+    page_keys = {}
+    for content in contents:
+        if not content:
+            continue
+        page_key = text_fingerprint(content)
+        if page_key not in page_keys:
+            _, _, keys = block_keys(html.fromstring(content))
+            page_keys[page_key] = frozenset(key for key in keys if key is not None)
+    return page_keys
+
+
+class SiteTemplate:
+    """The blocks that repeat across the pages of a site: navigation, sidebars, footers.
+
+    A block is part of the template when its key appears in at least
+    ``threshold`` of the site's pages, and in at least two of them. Cleaning a
+    page is then one lookup per element instead of a comparison with a
+    reference page.
+    """
+
+    def __init__(self, counts, pages, threshold=TEMPLATE_THRESHOLD):
+        self.pages = pages
+        self.threshold = threshold
+        min_pages = max(2, math.ceil(threshold * pages))
+        self.fingerprints = frozenset(key for key, count in counts.items() if count >= min_pages)
+        digest = hashlib.blake2b(digest_size=16)
+        for key in sorted(self.fingerprints):
+            digest.update(key.to_bytes(8, 'big'))
+        self.hash = digest.hexdigest()
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def remove_matches(self, soup, on_remove=None):
+        """Remove the template blocks of soup and return the removed elements."""
+        elements, spans, keys = block_keys(soup)
+        return remove_blocks(soup, elements, spans, lambda position: keys[position] in self.fingerprints, on_remove)
+
+
+def merge_counts(results, threshold=TEMPLATE_THRESHOLD, label=None):
+    """Build a SiteTemplate from the count_blocks results of several batches of one site.
+
+    A block is counted once per distinct page content, in whichever batches
+    the content appears.
+    """
+    # 内容相同的页面只算一次，哪怕分在不同批次里
+    page_keys = {}
+    for batch_keys in results:
+        page_keys.update(batch_keys)
+    counts = Counter()
+    for keys in page_keys.values():
+        counts.update(keys)
+    pages = len(page_keys)
+    template = SiteTemplate(counts, pages, threshold)
+    logging.info(f"Learned site template for {label}: {len(template)} blocks from {pages} pages")
+    return template
+
+
+def learn_template(contents, threshold=TEMPLATE_THRESHOLD, label=None):
+    """Learn the SiteTemplate of a site from the body HTML of its pages in one counting pass."""
+    return merge_counts([count_blocks(contents)], threshold, label)
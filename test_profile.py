@@ -0,0 +1,21 @@
+import threading
+import tracemalloc
+import pytest
+from clear_profile import ProfileTarget
+from clear_scheduler import clean_batch
+
+
+def failing_page(company, keys, references, rules, template, metrics=None, **options):
+    return metrics.call('parse', lambda: 1 / 0)
+
+
+def sampler_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'clear-profile-sampler']
+
+
+def test_failed_profiled_batch_stops_profiling():
+    assert not tracemalloc.is_tracing()
+    with pytest.raises(ZeroDivisionError):
+        clean_batch(failing_page, [({'url': 'x'}, {})], {}, {}, {}, None, ProfileTarget('x_hp.json'))
+    assert not tracemalloc.is_tracing()
+    assert sampler_threads() == []
@@ -0,0 +1,26 @@
+from lxml import html
+from clear_template import count_blocks, learn_template, merge_counts
+
+NAV = '<div class="nav"><a href="/">Home</a><a href="/about">About us</a></div>'
+HOME = f'<html><body>{NAV}<div class="main"><p>Welcome to the company home page.</p></div></body></html>'
+ABOUT = f'<html><body>{NAV}<div class="main"><p>The company was founded in 1998 and makes cables.</p></div></body></html>'
+
+
+def cleaned_text(template, content):
+    soup = html.fromstring(content)
+    template.remove_matches(soup)
+    return ' '.join(soup.text_content().split())
+
+
+def test_duplicate_page_is_counted_once():
+    # 同一页面以 x 和 x?utm_source=1 两个 url 抓到，内容相同
+    template = learn_template([HOME, ABOUT, ABOUT], threshold=0.5)
+    assert template.pages == 2
+    assert cleaned_text(template, ABOUT) == 'The company was founded in 1998 and makes cables.'
+
+
+def test_duplicate_page_in_other_batch_is_counted_once():
+    template = merge_counts([count_blocks([HOME, ABOUT]), count_blocks([ABOUT])], threshold=0.5)
+    assert template.pages == 2
+    assert cleaned_text(template, ABOUT) == 'The company was founded in 1998 and makes cables.'
+    assert cleaned_text(template, HOME) == 'Welcome to the company home page.'